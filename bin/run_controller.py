@@ -1,17 +1,37 @@
 #!/usr/bin/env python3
 
-from time import sleep
+import argparse
 from papertty.controller import Controller
+from papertty.sim import SimulatedEPD
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Show what other processes send on the display.')
+    p.add_argument('--sim', action='store_true',
+                   help='Use a simulated panel instead of the real one, and print how long it kept the '
+                        'panel busy when exiting')
+    p.add_argument('--sim-frames', metavar='DIR',
+                   help='With --sim, save what the simulated panel shows after each refresh here, as PNGs')
+    return p.parse_args()
 
 def main():
+    args = parse_args()
+
     print('Initializing...')
-    display = Controller(vcom=-2.06)
+    sim = SimulatedEPD(frames_dir=args.sim_frames) if args.sim else None
+    display = Controller(epd=sim, vcom=-2.06)
 
     print('Running...')
-    while True:  # events are handled by signal
-        if display.check_active():
-            display.run()
-        sleep(0.5)
+    try:
+        while True:  # events are handled by signal
+            if display.check_active():
+                display.run()
+
+            # show what's drawn in windows as it comes in, until a process asks for the whole display
+            display.show_windows()
+    finally:
+        display.close()
+        if sim is not None:
+            print(sim.report())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,132 @@
+'''
+This file notices when the console is changing faster than the display can
+usefully show, like while cat'ing a big file or running a verbose build.
+
+Refreshing the panel for every frame of that is wasted effort: nobody can read
+text scrolling past on e-paper, and every fast refresh adds ghosting. So while
+it lasts we only show the occasional summary of what's on the console, and once
+the output stops we show where it ended up with a single clean refresh.
+'''
+
+from collections import deque
+
+class BurstDetector:
+    '''
+    Decides when the console's output is a burst, and when the burst is over.
+
+    Parameters
+    ----------
+
+    rate : float
+        A burst starts when at least this many characters per second have changed
+        over the last window seconds...
+
+    min_frames : int
+        ...in at least this many frames (so that one big redraw, like clearing the
+        screen, isn't taken for a burst)
+
+    scroll_frames : int
+        A burst also starts after this many frames in a row that scrolled
+
+    window : float
+        How far back, in seconds, to look when measuring the rate of change
+
+    settle_time : float
+        A burst is over once the console hasn't changed for this many seconds
+
+    summary_interval : float
+        During a burst, show what's on the console at most every this many seconds
+
+    metrics : papertty.metrics.Metrics, optional
+        Where to count the bursts and the frames they skip
+    '''
+
+    def __init__(self, rate=2000, min_frames=5, scroll_frames=5, window=1, settle_time=1, summary_interval=2,
+                 metrics=None):
+        self.rate = rate
+        self.min_frames = min_frames
+        self.scroll_frames = scroll_frames
+        self.window = window
+        self.settle_time = settle_time
+        self.summary_interval = summary_interval
+
+        self.active = False
+        self.frames = deque()  # (time, characters changed) of the recent frames with changes
+        self.scroll_streak = 0
+        self.last_change = None
+        self.last_summary = None
+
+        self.bursts = 0
+        self.skipped = 0
+
+        if metrics is not None:
+            self.transitions = metrics.counter('burst_transitions_total',
+                                               'Times the console went into or out of a burst of output', label='to')
+            self.skipped_frames = metrics.counter('burst_frames_skipped_total',
+                                                  'Changed frames not drawn during bursts of output')
+        else:
+            self.transitions = self.skipped_frames = None
+
+    def observe(self, now, changed, scrolled):
+        '''
+        Account for a frame that was drawn, with changed characters (and whether
+        it scrolled). Returns whether a burst has started.
+        '''
+        if not changed:
+            return False
+
+        self.frames.append((now, changed))
+        while self.frames[0][0] < now - self.window:
+            self.frames.popleft()
+
+        self.scroll_streak = self.scroll_streak + 1 if scrolled else 0
+
+        cells = sum(count for _, count in self.frames)
+        if (len(self.frames) >= self.min_frames and cells >= self.rate*self.window) or \
+                self.scroll_streak >= self.scroll_frames:
+            self._start(now)
+            return True
+        return False
+
+    def summary_due(self, now):
+        '''
+        During a burst, whether it's time to draw the console again. Call summarized()
+        if it is drawn, and skip(now) if it isn't.
+        '''
+        return now - self.last_summary >= self.summary_interval
+
+    def summarized(self, now):
+        self.last_summary = now
+        self.last_change = now
+
+    def skip(self, now):
+        '''
+        Account for a changed frame that wasn't drawn during a burst.
+        '''
+        self.last_change = now
+        self.skipped += 1
+        if self.skipped_frames is not None:
+            self.skipped_frames.inc()
+
+    def settled(self, now):
+        '''
+        During a burst, whether the console has stopped changing. If it has, the
+        burst is over.
+        '''
+        if now - self.last_change < self.settle_time:
+            return False
+
+        self.active = False
+        if self.transitions is not None:
+            self.transitions.inc(label_value='normal')
+        return True
+
+    def _start(self, now):
+        self.active = True
+        self.frames.clear()
+        self.scroll_streak = 0
+        self.last_change = self.last_summary = now
+
+        self.bursts += 1
+        if self.transitions is not None:
+            self.transitions.inc(label_value='burst')
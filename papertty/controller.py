@@ -2,7 +2,19 @@
 This file defines two classes for controlling the e-paper display.
 
 The Controller class waits for input on some pipes (currently opened in tmp).
-When it gets input there, it puts the data it receives onto the display.
+When it gets input there, it puts the data it receives onto the display. A
+client that wants to send it data that way takes the lock file (which holds its
+pid, so that a lock left behind by a client that crashed can be taken over), and
+then says so over the controller's Unix socket, which wakes the controller up.
+
+Instead of taking over the whole display through the pipes, clients can open
+a window: a rectangle of the display, with a z-order, that they draw in through
+a shared-memory buffer in /dev/shm. The client draws directly into it, and only
+sends a small descriptor of each update (mode, rectangle, sequence number) over
+a Unix socket, so that the pixels don't need to be copied through the kernel.
+Any number of clients can have windows open at once. Windows with a higher z
+are drawn on top, and whatever isn't covered by a window (the terminal, when
+the Controller is run by PaperTTY) keeps being shown and updated around them.
 
 The AutoWorkerDisplay class is a derived class from AutoDisplay. Instead of
 directly updating the display like AutoEPDDisplay (from the IT8951 module) does,
@@ -12,32 +24,232 @@ but any process with an AutoWorkerDisplay instance doesn't need root.
 '''
 
 import array
+import errno
+import mmap
+import os
+import select
+import socket
 import struct
+import threading
+from contextlib import contextmanager
+from functools import reduce
+from time import perf_counter, sleep
 from os import mkfifo, remove, getpid, kill, umask
-from os.path import isfile, exists
+from os.path import exists
+import numpy as np
 from IT8951.display import AutoDisplay
-from IT8951.interface import EPD
+
+from .render import shared_frame
+from .planner import stronger_mode, boxes_overlap, box_intersection, subtract_boxes, box_union
+from .waveform import AUTO_MODE, MODE_NAMES, WaveformPolicy
+from .metrics import Metrics, InstrumentedEPD
+from .pixels import (BPP_FOR_MODE, SUPPORTED_BPP, pack, unpack, flip_packed, is_aligned,
+                     pixel_alignment, packed_size, load_packed, display_packed)
+
+# how clients send their pixels to the controller. (1 was a shared-memory frame
+# buffer for the whole display, which windows replaced)
+TRANSPORT_FIFO = 0
+TRANSPORT_WINDOW = 2
+
+# the first thing a client sends over the socket: transport, pid. a client that
+# has taken the lock sends TRANSPORT_FIFO, to have the controller start reading
+# the pipes, and then hangs up
+HELLO_FORMAT = 'hi'
+
+# then the window it wants: x, y, w, h, z. the controller replies with the
+# window's id (which names its buffer) and its x, y, w, h on the display
+WINDOW_FORMAT = 'hhhhh'
+WINDOW_REPLY_FORMAT = 'Ihhhh'
+
+# describes one update: mode, x, y, w, h, sequence number, bits per pixel to send to the panel
+UPDATE_FORMAT = 'hhhhhIB'
+
+# the header of an update through the pipes is mode, x, y, w, h. the high byte of
+# the mode is the protocol version; from version 1 on, the header continues with
+# the bits per pixel of the data that follows and a (so far unused) flags byte
+PIPE_HEADER_FORMAT = 'hhhhh'
+PIPE_HEADER_EXT_FORMAT = 'BB'
+PROTOCOL_VERSION = 1
+
+# the most areas a session keeps track of separately; after that they're merged
+MAX_SESSION_BOXES = 64
+
+# while waiting on the pipes, how often (in seconds) to check that the process
+# using the display still has it
+SESSION_CHECK_INTERVAL = 0.5
+
+# the controller's reply once an update has been displayed: sequence number.
+# an update that got dropped because a later one covered it is acknowledged
+# when the later one is displayed
+ACK_FORMAT = 'I'
+
+def recv_exactly(sock, nbytes):
+    '''
+    Receive exactly nbytes from sock, or return None if the other end
+    closed the connection first.
+    '''
+    buf = bytearray(nbytes)
+    view = memoryview(buf)
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            return None
+        view = view[received:]
+    return bytes(buf)
+
+def pid_alive(pid):
+    '''
+    Whether there is a process with the given pid.
+    '''
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # it exists, it just isn't ours
+    return True
+
+def read_lock(path):
+    '''
+    The pid in the lock file at path, or None if it doesn't hold one.
+    '''
+    with open(path) as f:
+        try:
+            return int(f.read().strip())
+        except ValueError:
+            return None  # not written by take_lock(), so nobody we know of holds it
+
+def lock_holder(path):
+    '''
+    The pid of the process holding the lock file at path, or None if nobody holds
+    it. A lock left behind by a process that has exited is removed.
+    '''
+    # several processes can find the same stale lock at once. each moves it to a name of
+    # its own first, so only one of them gets it, and checks that what it moved is still
+    # the stale lock: another process may have taken it over in the meantime
+    stale_path = '{}.stale.{}.{}'.format(path, getpid(), threading.get_ident())
+    while True:
+        try:
+            pid = read_lock(path)
+        except FileNotFoundError:
+            return None
+
+        if pid is not None and pid_alive(pid):
+            return pid
+
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            continue  # someone else got to it first; see who holds it now
+        except PermissionError:
+            return pid  # someone else's, and /tmp doesn't let us remove it
+
+        try:
+            pid = read_lock(stale_path)
+            if pid is None or not pid_alive(pid):
+                return None
+
+            # not stale after all, so put it back
+            try:
+                os.link(stale_path, path)
+            except FileExistsError:
+                pass
+            return pid
+        finally:
+            remove(stale_path)
+
+def take_lock(path):
+    '''
+    Create the lock file at path with our pid in it, taking over a lock left behind
+    by a process that has exited. Returns None if we got the lock, or else the pid
+    of the process that holds it.
+    '''
+    # the lock is created with the pid already in it, so nobody ever sees it empty
+    tmp_path = '{}.{}'.format(path, getpid())
+    with open(tmp_path, 'w') as f:
+        f.write('{}\n'.format(getpid()))
+
+    try:
+        for _ in range(2):
+            try:
+                os.link(tmp_path, path)
+                return None
+            except FileExistsError:
+                holder = lock_holder(path)
+                if holder is not None:
+                    return holder
+        return lock_holder(path)  # someone else took it over first
+    finally:
+        remove(tmp_path)
 
 class AutoWorkerDisplay(AutoDisplay):
     '''
     This class is a subclass of AutoDisplay, so it automatically
     tracks changes to its frame_buf attribute and sends display updates
     accordingly. However, this class doesn't update the display directly
-    but instead sends data to a running instance of the Controller class
+    but instead sends data to a running instance of the Controller class,
+    either through a window (see below), or by taking over the whole display
     through its named pipes.
+
+    Parameters
+    ----------
+
+    transport : str
+        'shm' to open a window and draw straight into its shared-memory buffer,
+        'fifo' to take over the whole display and send the pixels through the named
+        pipes, or 'auto' (the default) to use a window when the controller offers
+        them. Windows can't be used together with flip, since the controller reads
+        the unflipped pixels.
+
+    window : (int, int, int, int)
+        With the shm transport, the area of the display (x0, y0, x1, y1) to open a
+        window on. The frame buffer is the size of the window, and its coordinates
+        start at its corner. Default: the whole display
+
+    z : int
+        With the shm transport, the window's place in the stack: it covers the
+        windows with a lower z, and is covered by those with a higher one. Windows
+        with the same z stack in the order they were opened
+
+    max_in_flight : int
+        With the shm transport, how many updates can be sent before waiting for
+        the controller to acknowledge them. With more than one, the controller can
+        upload the next update while the panel is still showing the previous one.
+        Use wait() to wait for a particular update to be displayed. Since the
+        controller reads the pixels from shared memory when it gets to an update,
+        it may display newer pixels than were there when the update was sent.
+
+    packed : bool
+        Whether to send pixels at the fewest bits per pixel the waveform mode can
+        show (1 for DU/A2, 4 for the grayscale modes) instead of 8. This cuts the
+        data through the pipes and over SPI by 2-8x.
+
+    Several draws can be shown with a single refresh by doing them in a batch():
+
+        with display.batch():
+            for widget in widgets:
+                widget.draw(display.frame_buf)
+                display.draw_partial(DisplayModes.DU)
     '''
 
-    def __init__(self, **kwargs):
+    def __init__(self, transport='auto', max_in_flight=1, packed=True, window=None, z=0, **kwargs):
 
-        # attempt to get lock on display. our lock is just creating a file
-        try:
-            open(Controller.lock_path, 'x').close()
-            self.have_lock = True
-        except FileExistsError:
-            self.have_lock = False
-            raise RuntimeError('Could not get a lock on display controller. '
-                               'Is another process using it? If not, delete '
-                               '{}'.format(Controller.lock_path))
+        # __del__ looks at these, even if we don't get any further
+        self.sock = None
+        self.have_lock = False
+
+        if transport == 'auto':
+            transport = 'shm' if exists(Controller.socket_path) and not kwargs.get('flip') else 'fifo'
+        elif transport == 'shm' and kwargs.get('flip'):
+            raise ValueError('the shared-memory transport does not support flip; '
+                             'set flip on the controller instead')
+        elif transport not in ('shm', 'fifo'):
+            raise ValueError('unknown transport {}'.format(transport))
+
+        self.transport = transport
+        self.packed = packed
+        self.ready_pending = False  # whether the controller is waiting to tell us it's ready
+        self.batched = None         # the areas drawn in the current batch()
 
         # get width and height
         try:
@@ -47,12 +259,69 @@ class AutoWorkerDisplay(AutoDisplay):
         except FileNotFoundError:
             raise FileNotFoundError('Could not find display info. Is the daemon running?')
 
+        self.display_pid = pid
+
+        if self.transport == 'shm':
+            if window is None:
+                window = (0, 0, width, height)
+
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(Controller.socket_path)
+            self.sock.sendall(struct.pack(HELLO_FORMAT, TRANSPORT_WINDOW, getpid()))
+            self.sock.sendall(struct.pack(WINDOW_FORMAT, window[0], window[1],
+                                          window[2]-window[0], window[3]-window[1], z))
+
+            reply = recv_exactly(self.sock, struct.calcsize(WINDOW_REPLY_FORMAT))
+            if reply is None:
+                self.sock.close()
+                raise RuntimeError('Display controller refused the window {}'.format(window))
+            self.window_id, x, y, width, height = struct.unpack(WINDOW_REPLY_FORMAT, reply)
+            self.window = (x, y, x+width, y+height)
+
+        else:
+            # attempt to get lock on display. our lock is a file with our pid in it
+            holder = take_lock(Controller.lock_path)
+            if holder is not None:
+                raise RuntimeError('Could not get a lock on display controller: '
+                                   'process {} is using it'.format(holder))
+            self.have_lock = True
+
+            # and tell the controller to start reading the pipes
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(Controller.socket_path)
+                    sock.sendall(struct.pack(HELLO_FORMAT, TRANSPORT_FIFO, getpid()))
+            except OSError:
+                remove(Controller.lock_path)
+                self.have_lock = False
+                raise
+
         AutoDisplay.__init__(self, width, height, **kwargs)
 
-        self.display_pid = pid
+        # sequence numbers of the updates the controller hasn't acknowledged yet
+        self.seq = 0
+        self.in_flight = set()
+        self.max_in_flight = max_in_flight
+
+        if self.transport == 'shm':
+            # draw straight into the window's buffer
+            with open(Controller.window_shm_path.format(self.window_id), 'r+b') as f:
+                self.shm = mmap.mmap(f.fileno(), width*height)
+            pixels = np.frombuffer(self.shm, dtype=np.uint8).reshape(height, width)
+            self.frame_buf = shared_frame(pixels)
 
     def __del__(self):
+        if self.sock is not None:
+            # tell managing process that we're done with our window
+            try:
+                self.sock.sendall(struct.pack(UPDATE_FORMAT, -1, 0, 0, 0, 0, 0, 0))
+            except OSError:
+                pass
+            self.sock.close()
+
         if self.have_lock:
+            self._wait_ready()
+
             # tell managing process that we're done sending stuff
             done_attrs = struct.pack('hhhhh', -1, 0, 0, 0, 0)
             with open(Controller.data_path, 'wb') as pipe:
@@ -66,50 +335,352 @@ class AutoWorkerDisplay(AutoDisplay):
         This function is called by the functions defined in AutoDisplay
         when it needs to update the display.
         '''
+        if self.batched is not None:
+            # it gets sent when the batch ends
+            self.batched.append(((xy[0], xy[1], xy[0]+dims[0], xy[1]+dims[1]), mode))
+            return
+
+        self._send(xy, dims, mode, data)
+
+    @contextmanager
+    def batch(self, mode=None, wait=True):
+        '''
+        Collect the areas that draw_partial() and draw_full() update inside the
+        with block, and send them to the controller as one update when it ends,
+        so that they take one round trip and one refresh of the panel instead of
+        one each.
+
+        The refresh covers the smallest rectangle around all of the areas. The
+        panel's image buffer in between them can't be trusted to hold what the
+        panel shows, so that is sent along from the frame buffer, and whatever
+        the frame buffer has there gets shown too.
 
-        attrs = struct.pack('hhhhh', mode, xy[0], xy[1], dims[0], dims[1])
+        Parameters
+        ----------
+
+        mode : int
+            The waveform mode to refresh with. Default: the strongest of the modes
+            that were drawn with, or AUTO_MODE if any of them was
+
+        wait : bool
+            Whether to wait for the refresh to be displayed. Otherwise, this returns
+            as soon as the update is sent, and the next update (or wait()) waits for it
+        '''
+        self.batched = []
+        try:
+            yield self
+        finally:
+            batched, self.batched = self.batched, None
+
+            if batched:
+                box = reduce(box_union, (box for box, _ in batched))
+                if mode is None:
+                    modes = [drawn_mode for _, drawn_mode in batched]
+                    mode = AUTO_MODE if AUTO_MODE in modes else reduce(stronger_mode, modes)
+
+                self._send(box[:2], (box[2]-box[0], box[3]-box[1]), mode, wait=wait)
+                if wait:
+                    self.wait()
+
+    def _send(self, xy, dims, mode, data=None, wait=True):
+        '''
+        Send an update to the controller. The pixels are taken from the frame buffer,
+        if data (the area's pixels at 8 bits per pixel) isn't given. If wait is False,
+        don't wait for the controller to be ready for the next one.
+        '''
+        bpp = BPP_FOR_MODE.get(mode, 8) if self.packed else 8
+
+        if self.transport == 'shm':
+            # the pixels are already in shared memory, so just say where they are
+            self.seq += 1
+            self.sock.sendall(struct.pack(UPDATE_FORMAT, mode, xy[0], xy[1], dims[0], dims[1], self.seq, bpp))
+            self.in_flight.add(self.seq)
+
+            # wait for display to be ready, if we have too many updates queued
+            while wait and len(self.in_flight) >= self.max_in_flight:
+                self._receive_ack()
+            return
+
+        # the controller may still be displaying an update we didn't wait for
+        self._wait_ready()
+
+        if bpp < 8:
+            # packed areas need to be a whole number of words wide, so widen the area
+            # if necessary and get the pixels ourselves
+            align = pixel_alignment(bpp)
+            x0 = xy[0] - xy[0] % align
+            x1 = min(xy[0] + dims[0] + (-(xy[0] + dims[0]) % align), self.width)
+            xy, dims = (x0, xy[1]), (x1 - x0, dims[1])
+            if not is_aligned(xy, dims, bpp):
+                # the widened area ran into the edge of the display, so send all of it at
+                # 8bpp, from the frame buffer (data only covers the area we were given)
+                bpp = 8
+                data = None
+
+        if bpp < 8:
+            data = pack(self._crop(xy, dims), bpp)
+        elif data is None:
+            data = self._crop(xy, dims).ravel()
+        else:
+            data = array.array('B', data)
+
+        attrs = struct.pack(PIPE_HEADER_FORMAT, mode | (PROTOCOL_VERSION << 8), xy[0], xy[1], dims[0], dims[1])
+        attrs += struct.pack(PIPE_HEADER_EXT_FORMAT, bpp, 0)
 
         with open(Controller.data_path, 'wb') as pipe:
             pipe.write(attrs)
-            array.array('B', data).tofile(pipe)
+            pipe.write(data)
+
+        self.ready_pending = True
+        if wait:
+            self._wait_ready()
+
+    def _wait_ready(self):
+        '''
+        Wait for the controller to say it's ready for the next update through the
+        pipes, if it hasn't yet.
+        '''
+        if self.ready_pending:
+            with open(Controller.ready_path, 'rb') as f:
+                f.read()
+            self.ready_pending = False
+
+    def _crop(self, xy, dims):
+        '''
+        Get the pixels of an area of the display (which is flipped from the
+        frame buffer, if flip is set) as a numpy array.
+        '''
+        x0, y0 = xy
+        x1, y1 = x0 + dims[0], y0 + dims[1]
+        if self.flip:
+            box = (self.width - x1, self.height - y1, self.width - x0, self.height - y0)
+            return np.asarray(self.frame_buf.crop(box))[::-1, ::-1]
+        return np.asarray(self.frame_buf.crop((x0, y0, x1, y1)))
+
+    def wait(self, seq=None):
+        '''
+        Wait until the update with sequence number seq (by default the most recent
+        one) has been displayed. Updates sent through the pipes are waited for as they
+        are sent, except for a batch() that didn't wait, which this waits for.
+        '''
+        self._wait_ready()
+
+        if seq is None:
+            seq = self.seq
+
+        while seq in self.in_flight:
+            self._receive_ack()
+
+    def _receive_ack(self):
+        ack = recv_exactly(self.sock, struct.calcsize(ACK_FORMAT))
+        if ack is None:
+            raise RuntimeError('Display controller closed the connection')
+
+        seq, = struct.unpack(ACK_FORMAT, ack)
+        self.in_flight.discard(seq)
+
+class UpdateQueue:
+    '''
+    The updates a client has sent but that haven't been displayed yet.
+
+    When an update is added that completely covers one that is still queued, the
+    queued one is dropped (its sequence number is acknowledged along with the new
+    one), and the new one gets whichever of the two waveform modes is stronger.
+    If either of them asked for AUTO_MODE, the new one keeps its own mode, since
+    that was chosen for everything it covers.
+    '''
 
-        # wait for display to be ready
-        with open(Controller.ready_path, 'rb') as f:
-            f.read()
+    def __init__(self):
+        self.items = []
+        self.dropped = 0
+        self.cond = threading.Condition()
+
+    def put(self, box, mode, seq, bpp=8):
+        with self.cond:
+            covered = []
+            remaining = []
+            for item in self.items:
+                if box_contains(box, item['box']):
+                    covered.extend(item['covered'])
+                    covered.append(item['seq'])
+                    if AUTO_MODE not in (mode, item['mode']):
+                        mode = stronger_mode(mode, item['mode'])
+                    bpp = max(bpp, item['bpp'])
+                    self.dropped += 1
+                else:
+                    remaining.append(item)
+
+            remaining.append({'box': box, 'mode': mode, 'seq': seq, 'bpp': bpp, 'covered': covered})
+            self.items = remaining
+
+    def take(self):
+        '''
+        Get all of the queued updates, oldest first, and empty the queue.
+        '''
+        with self.cond:
+            items, self.items = self.items, []
+            return items
+
+def box_contains(outer, inner):
+    return (outer[0] <= inner[0] and outer[1] <= inner[1] and
+            outer[2] >= inner[2] and outer[3] >= inner[3])
+
+class Window:
+    '''
+    A client's window: an area of the display, and the shared-memory buffer that
+    the client draws it in.
+
+    Parameters
+    ----------
+
+    id : int
+        Unique for each window the controller opens; it names the buffer
+
+    box : (int, int, int, int)
+        Where the window is on the display (x0, y0, x1, y1)
+
+    z : int
+        Where the window is in the stack (higher is on top)
+
+    conn : socket.socket
+        The connection to the client
+
+    path : str
+        Where to create the buffer
+    '''
+
+    def __init__(self, id, box, z, conn, path):
+        self.id = id
+        self.box = box
+        self.z = z
+        self.conn = conn
+        self.path = path
+
+        self.queue = UpdateQueue()
+
+        width, height = box[2]-box[0], box[3]-box[1]
+
+        # clients don't need root, so neither does the buffer. the umask would take
+        # permissions away, so set them on the file itself
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            os.fchmod(fd, 0o666)
+            os.ftruncate(fd, width*height)
+            self.shm = mmap.mmap(fd, width*height)
+        except OSError:
+            remove(path)
+            raise
+        finally:
+            os.close(fd)
+
+        self.pixels = np.frombuffer(self.shm, dtype=np.uint8).reshape(height, width)
+        self.pixels[:] = 0xFF
+
+    def stacking(self):
+        '''
+        A key to sort windows by, from the bottom of the stack to the top.
+        '''
+        return self.z, self.id
+
+    def close(self):
+        if exists(self.path):
+            remove(self.path)
 
 class Controller:
     '''
     This class receives data from other processes and displays it on the
-    e-paper display. When activated (by a process creating the lock file,
-    and then check_active() and run() being called in that order)
-    it waits for data in its named pipes until it receives
-    a special set of data that tell it to deactivate.
+    e-paper display. When activated (by a process taking the lock file and
+    saying so over the socket, and then check_active() and run() being
+    called in that order) it waits for data in its named pipes until it
+    receives a special set of data that tell it to deactivate.
+
+    Meanwhile, any number of clients can connect to its socket to open
+    windows, which it serves on background threads. Their updates are
+    queued until someone takes them: either whoever draws the rest of the
+    display (PaperTTY's Runner, which refreshes them together with the
+    terminal's changes), using take_updates(), compose() and ack(), or
+    show_windows(), which displays them on their own.
+
+    Clients can ask for AUTO_MODE instead of a particular waveform mode,
+    to have the policy choose one from the pixels of each update.
+
+    Parameters
+    ----------
+
+    epd : IT8951.interface.EPD
+        The display (default: a new one, with the given vcom). A
+        sim.SimulatedEPD works too
+
+    flip : bool
+        Rotate everything clients send by 180 degrees
+
+    policy : waveform.WaveformPolicy
+        Chooses the mode for AUTO_MODE updates (default: WaveformPolicy())
+
+    shown : np.ndarray
+        An array the size of the display that holds what the panel is showing,
+        which we keep up to date. Pass one to share it with whoever else draws
+        on the display
+
+    metrics : metrics.Metrics
+        Where to keep timings and counts (default: a new Metrics)
+
+    on_update : callable
+        Called (on another thread) whenever there is something new in the windows
+        to display, a window has closed, or a process wants to take over the display
     '''
 
     data_path = '/tmp/epd_data'
     ready_path = '/tmp/epd_ready'
     info_path = '/tmp/epd_info'
     lock_path = '/tmp/epd_lock'
+    socket_path = '/tmp/epd_socket'
+    window_shm_path = '/dev/shm/epd_window_{}'
 
-    def __init__(self, epd=None, vcom=None, flip=False):
+    def __init__(self, epd=None, vcom=None, flip=False, policy=None, shown=None, metrics=None, on_update=None):
 
         # track what files we have made so we can clean up at the end
         # we can't be sure we've made everything if e.g. there is an
         # exception raised while this is happening
         self.files_created = []
+        self.windows = []
+        self.listener = None
+        self.accept_thread = None
 
         if exists(self.info_path):
             raise RuntimeError('Display files already exist. Is there another '
                                'instance running?')
 
+        # a client that crashed while it had the display shouldn't lock everyone else out
+        holder = lock_holder(self.lock_path)
+        if holder is not None:
+            print('Process {} holds the display lock; waiting for it to let go'.format(holder))
+
         if epd is None:
+            from IT8951.interface import EPD
             epd = EPD(vcom)
 
+        self.metrics = Metrics() if metrics is None else metrics
+        if not isinstance(epd, InstrumentedEPD):
+            epd = InstrumentedEPD(epd, self.metrics)
+
+        self.sessions = self.metrics.counter('controller_sessions_total', 'Times another process used the display')
+        self.dropped = self.metrics.counter('controller_dropped_updates_total',
+                                            'Updates skipped because a later one covered them')
+        self.receive_time = self.metrics.histogram('controller_receive_seconds',
+                                                   'Time spent receiving pixels through the pipes')
+        self.windows_opened = self.metrics.counter('controller_windows_total', 'Windows that clients opened')
+
         self.epd = epd
         self.width = self.epd.width
         self.height = self.epd.height
         self.flip = flip
 
+        self.policy = WaveformPolicy() if policy is None else policy
+        if shown is None:
+            shown = np.full((self.height, self.width), 0xFF, dtype=np.uint8)
+        self.shown = shown
+
         # we need to set the permissions of the named pipes correctly so
         # that this class can be run as root, but the communicating processes
         # don't need root
@@ -121,32 +692,429 @@ class Controller:
         mkfifo(self.ready_path)
         self.files_created.append(self.ready_path)
 
+        # the socket that clients open windows through. this also needs to be
+        # usable by processes without root
+        old_umask = umask(0)
+        try:
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(self.socket_path)
+            self.files_created.append(self.socket_path)
+        finally:
+            umask(old_umask)
+
+        self.listener.listen(4)
+
         with open(self.info_path, 'w') as f:
             f.write('{},{},{}\n'.format(self.width, self.height, getpid()))
         self.files_created.append(self.info_path)
 
         self.active = False
 
+        # the pid of the process that has asked to take over the display, until
+        # check_active() sees it, and of the one that has it, while it does
+        self.takeover = None
+        self.session_pid = None
+
+        # the area the panel may still be refreshing from our last update
+        self.busy_box = None
+
+        # the areas of the panel (x0, y0, x1, y1) that the last session wrote to, so
+        # that whoever uses the display next knows what it needs to redraw
+        self.session_boxes = []
+        self.session_updates = 0
+
+        # the areas of the display that closed windows (self.windows has the open
+        # ones) left behind, which need to show whatever was under them again
+        self.damage = []
+        self.last_window_id = 0
+        self.window_cond = threading.Condition()
+        self.on_update = on_update
+
+        # what show_windows() displays: the windows, over what the panel shows
+        self.composed = np.full((self.height, self.width), 0xFF, dtype=np.uint8)
+
+        self.accept_thread = threading.Thread(target=self._accept_clients, daemon=True)
+        self.accept_thread.start()
+
     def __del__(self):
+        self.close()
+
+    def close(self):
+        '''
+        Stop taking clients, close the windows they have open, and remove the files
+        we made. The thread that takes clients keeps a reference to us, so we can't
+        leave this to __del__.
+        '''
+        if self.listener is not None:
+            # shutting the socket down is what wakes up accept()
+            try:
+                self.listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.listener.close()
+            self.listener = None
+
+        if self.accept_thread is not None:
+            self.accept_thread.join()
+            self.accept_thread = None
+
+        for window in list(self.windows):
+            try:
+                window.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            window.close()
+
         for f in self.files_created:
-            remove(f)
+            if exists(f):
+                remove(f)
+        self.files_created = []
+
+    def takeover_requested(self):
+        '''
+        Whether a process has asked to take over the display.
+        '''
+        with self.window_cond:
+            return self.takeover is not None
 
     def check_active(self):
-        # we are active if the lock file exists (i.e. someone is trying to
-        # get a lock on the display)
-        if isfile(self.lock_path):
-            self.active = True
-            return True
-        else:
+        '''
+        Become active if a process has asked to take over the display (which it
+        does after getting the lock). Returns whether we did, in which case run()
+        should be called next.
+        '''
+        with self.window_cond:
+            pid, self.takeover = self.takeover, None
+
+        # it may have let go of the lock (or died) since it asked
+        if pid is None or lock_holder(self.lock_path) != pid:
             return False
 
+        self.session_pid = pid
+        self.active = True
+
+        # someone else may have used the display since our last update
+        self.busy_box = None
+        return True
+
     def run(self):
         '''
         Run the display update loop. Stop either if we have deactivated,
         or if we receive SIGINT
         '''
+        self.sessions.inc()
+        self.session_boxes = []
+        self.session_updates = 0
+
         while self.active:
             self.update_epd()
+        self.session_pid = None
+
+    def _session_over(self):
+        '''
+        Whether the process using the display has stopped holding the lock without
+        saying it was done (because it died, say), or another process that has taken
+        the lock over has asked for the display.
+        '''
+        with self.window_cond:
+            if self.takeover is not None and self.takeover != self.session_pid:
+                return True
+        return lock_holder(self.lock_path) != self.session_pid
+
+    def _open_data_pipe(self):
+        '''
+        Wait for the client to send an update through the data pipe, and open it.
+        Returns None, instead of waiting forever, if the session ends first.
+        '''
+        # opening the pipe for reading would block until a client opens it for writing,
+        # so open it without blocking, and wait for the update with poll()
+        fd = os.open(self.data_path, os.O_RDONLY | os.O_NONBLOCK)
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        while not poller.poll(SESSION_CHECK_INTERVAL*1000):
+            if self._session_over():
+                os.close(fd)
+                return None
+
+        # the update may be from a process that took the lock over, and got to the pipe
+        # before we noticed. then the display is its now, without a restore in between
+        with self.window_cond:
+            pid = self.takeover
+            if pid is not None and pid != self.session_pid:
+                self.takeover = None
+        if pid is not None and pid != self.session_pid and lock_holder(self.lock_path) == pid:
+            self.session_pid = pid
+            self.sessions.inc()
+
+        os.set_blocking(fd, True)
+        return os.fdopen(fd, 'rb')
+
+    def _signal_ready(self):
+        '''
+        Tell the client we're ready for the next update, by opening the ready pipe for
+        it to see. Returns False if the session ended before the client was listening.
+        '''
+        # opening a pipe for writing without blocking fails until there is a reader,
+        # and there's nothing to wait on for one to show up, so keep trying
+        delay = 0.0005
+        checked = perf_counter()
+        while True:
+            try:
+                os.close(os.open(self.ready_path, os.O_WRONLY | os.O_NONBLOCK))
+                return True
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+
+            if perf_counter() - checked > SESSION_CHECK_INTERVAL:
+                if self._session_over():
+                    return False
+                checked = perf_counter()
+
+            sleep(delay)
+            delay = min(2*delay, 0.01)
+
+    def _accept_clients(self):
+        listener = self.listener  # close() clears it
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return  # closed
+
+            threading.Thread(target=self._serve_client, args=(conn,), daemon=True).start()
+
+    def _serve_client(self, conn):
+        '''
+        Handle a client that has connected to the socket: either one that has the
+        lock and wants the whole display, or one that wants a window, in which case
+        we open it and queue its updates until it says it is done or disconnects.
+        '''
+        with conn:
+            hello = recv_exactly(conn, struct.calcsize(HELLO_FORMAT))
+            if hello is None:
+                return
+
+            transport, pid = struct.unpack(HELLO_FORMAT, hello)
+            if transport == TRANSPORT_FIFO:
+                # only the process holding the lock gets to take over. the pid in the
+                # hello is whatever the client says, so ask the kernel who it is. if
+                # another process has the display, this one took the lock over from
+                # it, and the session that's running ends (see _session_over())
+                creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+                pid, _, _ = struct.unpack('3i', creds)
+                if lock_holder(self.lock_path) == pid:
+                    with self.window_cond:
+                        self.takeover = pid
+                        self.window_cond.notify_all()
+                    self._notify()
+                return
+
+            request = recv_exactly(conn, struct.calcsize(WINDOW_FORMAT))
+            if request is None:
+                return
+
+            x, y, w, h, z = struct.unpack(WINDOW_FORMAT, request)
+            box = (max(x, 0), max(y, 0), min(x+w, self.width), min(y+h, self.height))
+            if transport != TRANSPORT_WINDOW or box[0] >= box[2] or box[1] >= box[3]:
+                return
+
+            with self.window_cond:
+                self.last_window_id += 1
+                window_id = self.last_window_id
+
+            try:
+                window = Window(window_id, box, z, conn, self.window_shm_path.format(window_id))
+            except OSError as e:
+                print('Could not open a window: {}'.format(e))
+                return
+
+            try:
+                conn.sendall(struct.pack(WINDOW_REPLY_FORMAT, window.id, box[0], box[1],
+                                         box[2]-box[0], box[3]-box[1]))
+                with self.window_cond:
+                    self.windows.append(window)
+                self.windows_opened.inc()
+
+                self._receive_updates(conn, window)
+            finally:
+                with self.window_cond:
+                    if window in self.windows:
+                        self.damage.extend(self._visible(window))
+                        self.windows.remove(window)
+                    self.window_cond.notify_all()
+                window.close()
+                self._notify()
+
+    def _receive_updates(self, conn, window):
+        '''
+        Read update descriptors from a window's client and queue them, until the
+        client says it is done or disconnects.
+        '''
+        update_size = struct.calcsize(UPDATE_FORMAT)
+        x0, y0 = window.box[:2]
+        try:
+            while True:
+                msg = recv_exactly(conn, update_size)
+                if msg is None:
+                    break
+
+                mode, x, y, w, h, seq, bpp = struct.unpack(UPDATE_FORMAT, msg)
+                if mode == -1:
+                    break
+
+                if bpp not in SUPPORTED_BPP:
+                    bpp = 8
+                if mode not in MODE_NAMES:
+                    mode = AUTO_MODE
+
+                # the client's coordinates are relative to its window
+                box = box_intersection((x0+x, y0+y, x0+x+w, y0+y+h), window.box)
+                if box is None:
+                    conn.sendall(struct.pack(ACK_FORMAT, seq))
+                    continue
+
+                with self.window_cond:
+                    window.queue.put(box, mode, seq, bpp)
+                    self.window_cond.notify_all()
+                self._notify()
+        except OSError:
+            pass
+
+    def _notify(self):
+        if self.on_update is not None:
+            self.on_update()
+
+    def _visible(self, window):
+        '''
+        The parts of a window that aren't covered by the windows above it. Call
+        with self.window_cond held.
+        '''
+        above = [other.box for other in self.windows if other.stacking() > window.stacking()]
+        return subtract_boxes(window.box, above)
+
+    def has_updates(self):
+        '''
+        Whether there's anything new in the windows to display.
+        '''
+        with self.window_cond:
+            return bool(self.damage) or any(window.queue.items for window in self.windows)
+
+    def take_updates(self):
+        '''
+        Take what needs displaying from the windows.
+
+        Returns
+        -------
+
+        updates : list
+            One dict for each update from a client, with the parts of the
+            display it covers that its window is visible in as 'rects', and its
+            'mode' and 'bpp'. Pass the list to ack() once they're displayed
+
+        damage : list
+            The areas that closed windows left behind, as (x0, y0, x1, y1)
+            boxes, which need to show whatever is under them again
+        '''
+        with self.window_cond:
+            updates = []
+            for window in self.windows:
+                visible = self._visible(window)
+                for item in window.queue.take():
+                    rects = [box_intersection(item['box'], box) for box in visible]
+                    updates.append({
+                        'rects': [rect for rect in rects if rect is not None],
+                        'mode': item['mode'],
+                        'bpp': item['bpp'],
+                        'conn': window.conn,
+                        'seqs': item['covered'] + [item['seq']],
+                    })
+
+                self.dropped.inc(window.queue.dropped)
+                window.queue.dropped = 0
+
+            damage, self.damage = self.damage, []
+            return updates, damage
+
+    def ack(self, updates):
+        '''
+        Tell the clients that updates (from take_updates) have been displayed.
+        '''
+        for update in updates:
+            try:
+                for seq in update['seqs']:
+                    update['conn'].sendall(struct.pack(ACK_FORMAT, seq))
+            except OSError:
+                pass  # it has gone away
+
+    def compose(self, frame):
+        '''
+        Draw the windows onto frame (an array the size of the display), in order
+        from the bottom of the stack to the top.
+        '''
+        with self.window_cond:
+            for window in sorted(self.windows, key=Window.stacking):
+                x0, y0, x1, y1 = window.box
+                frame[y0:y1, x0:x1] = window.pixels
+
+    def uncovered(self, box):
+        '''
+        The parts of box that aren't covered by any window.
+        '''
+        with self.window_cond:
+            return subtract_boxes(box, [window.box for window in self.windows])
+
+    def show_windows(self, timeout=None):
+        '''
+        Wait up to timeout seconds for the windows to have something to display,
+        and display it. This is for when nothing else is drawing on the display;
+        the areas not covered by windows keep showing what they did, so a window
+        that closes with nothing under it leaves its last image on the panel (as a
+        process that took over the display does). It also returns as soon as a
+        process asks to take over the display.
+        '''
+        with self.window_cond:
+            self.window_cond.wait_for(lambda: self.has_updates() or self.takeover is not None, timeout)
+
+        updates, damage = self.take_updates()
+        if not updates and not damage:
+            return
+
+        self.composed[:] = self.shown[::-1, ::-1] if self.flip else self.shown
+        self.compose(self.composed)
+
+        for box in damage:
+            self._display_composed(box, AUTO_MODE, 8)
+        for update in updates:
+            for box in update['rects']:
+                self._display_composed(box, update['mode'], update['bpp'])
+
+        self.ack(updates)
+
+    def _display_composed(self, box, mode, bpp):
+        '''
+        Display an area of self.composed.
+        '''
+        x0, y0, x1, y1 = box
+
+        if bpp < 8:
+            # we have the whole frame, so we can widen the area to what packing needs
+            align = pixel_alignment(bpp)
+            x0 -= x0 % align
+            x1 = min(x1 + (-x1 % align), self.width)
+
+        if self.flip:
+            xy = (self.width - x1, self.height - y1)
+            data = self.composed[y0:y1, x0:x1][::-1, ::-1]
+        else:
+            xy = x0, y0
+            data = self.composed[y0:y1, x0:x1]
+        dims = (x1-x0, y1-y0)
+
+        if bpp < 8 and not is_aligned(xy, dims, bpp):
+            bpp = 8
+
+        self.display(pack(data, bpp), xy, dims, mode, bpp)
 
     def update_epd(self):
         '''
@@ -154,43 +1122,105 @@ class Controller:
         on the EPD.
         '''
 
-        with open(self.data_path, 'rb') as f:
+        f = self._open_data_pipe()
+        if f is None:
+            self.active = False
+            return
+
+        with f:
 
             # first ten bytes are info about update
-            attrs = f.read(10)
-            mode, x, y, w, h = struct.unpack('hhhhh', attrs)
+            attrs = f.read(struct.calcsize(PIPE_HEADER_FORMAT))
+            if len(attrs) < struct.calcsize(PIPE_HEADER_FORMAT):
+                return  # the client hung up without sending anything
+            mode, x, y, w, h = struct.unpack(PIPE_HEADER_FORMAT, attrs)
 
             # if mode is -1, that means we're done sending data
             if mode == -1:
                 self.active = False
                 return
 
+            # newer clients put the protocol version in the high byte of the mode,
+            # and follow the header with the format of the pixels
+            version, mode = mode >> 8, mode & 0xFF
+            if version >= 1:
+                ext = f.read(struct.calcsize(PIPE_HEADER_EXT_FORMAT))
+                if len(ext) < struct.calcsize(PIPE_HEADER_EXT_FORMAT):
+                    return  # the client died while sending it
+                bpp, _ = struct.unpack(PIPE_HEADER_EXT_FORMAT, ext)
+            else:
+                bpp = 8
+
             # the rest is pixel data
-            data = array.array('B')
-            data.fromfile(f, w*h)
+            with self.receive_time.time():
+                data = np.frombuffer(f.read(packed_size((w, h), bpp)), dtype=np.uint8)
+            if data.size < packed_size((w, h), bpp):
+                return  # the client died while sending it
 
         if self.flip:
             xy = (self.width - x - w, self.height - y - h)
-            data = data[::-1]
+            data = flip_packed(data, bpp)
         else:
             xy = x, y
         dims = w, h
 
-        # send image to controller
-        self.epd.wait_display_ready()
-        self.epd.load_img_area(
-            data,
-            xy=xy,
-            dims=dims,
-        )
+        if bpp < 8 and not is_aligned(xy, dims, bpp):
+            # flipping moved the area off the word boundaries
+            data = unpack(data, bpp, w)
+            bpp = 8
 
-        # display sent image
-        self.epd.display_area(
-            xy,
-            dims,
-            mode
-        )
+        self.display(data, xy, dims, mode, bpp)
 
         # connect to pipe to tell that we are ready
-        with open(self.ready_path, 'wb') as f:
-            pass
+        if not self._signal_ready():
+            self.active = False
+
+    def display(self, data, xy, dims, mode, bpp=8):
+        '''
+        Send the image data for the area at xy with size dims to the
+        controller, and display it with the given mode. The data is packed
+        at bpp bits per pixel.
+        '''
+
+        box = (xy[0], xy[1], xy[0]+dims[0], xy[1]+dims[1])
+
+        pixels = unpack(data, bpp, dims[0])
+        shown = self.shown[box[1]:box[3], box[0]:box[2]]
+        if mode == AUTO_MODE:
+            mode = self.policy.select(pixels, shown)
+            if mode is None:
+                return  # it's already showing
+        shown[:] = pixels
+
+        self.refresh(data, xy, dims, mode, bpp)
+
+        self.session_updates += 1
+        self.session_boxes.append(box)
+        if len(self.session_boxes) > MAX_SESSION_BOXES:
+            union = self.session_boxes[0]
+            for other in self.session_boxes[1:]:
+                union = box_union(union, other)
+            self.session_boxes = [union]
+
+    def refresh(self, data, xy, dims, mode, bpp=8):
+        '''
+        Load the pixels of the area at xy with size dims, packed at bpp bits per
+        pixel, into the controller, and start displaying them with the given mode,
+        without waiting for the refresh to finish. PaperTTY sends the terminal this
+        way too, so that we know what the panel is busy with.
+        '''
+        box = (xy[0], xy[1], xy[0]+dims[0], xy[1]+dims[1])
+
+        # the controller can take new pixels while the previous waveform is still
+        # running, as long as they don't go where that waveform is being applied.
+        # that way the SPI transfer overlaps with the panel refresh
+        if self.busy_box is None or boxes_overlap(box, self.busy_box):
+            self.epd.wait_display_ready()
+
+        # send image to controller
+        load_packed(self.epd, data, xy, dims, bpp)
+
+        # display sent image
+        self.epd.wait_display_ready()
+        display_packed(self.epd, xy, dims, mode, bpp)
+        self.busy_box = box
@@ -0,0 +1,122 @@
+'''
+This file keeps track of where ghosting is building up on the display.
+
+The fast waveforms (DU, A2) leave a faint trace of whatever was there before,
+and it gets worse with every fast refresh of the same pixels. A GC16 refresh
+cleans it up, but it flashes and is slow, so rather than refreshing the whole
+panel every so often we count the fast refreshes each part of the screen has
+had, and only clean the parts that need it.
+'''
+
+import numpy as np
+from IT8951.constants import DisplayModes
+
+# refreshes that leave ghosting behind
+FAST_MODES = (DisplayModes.A2, DisplayModes.DU, DisplayModes.DU4)
+
+# refreshes that leave the pixels clean
+CLEAN_MODES = (DisplayModes.GC16, DisplayModes.INIT)
+
+class GhostTracker:
+    '''
+    Counts the fast refreshes that each tile of the display has received since
+    it was last refreshed with a clean waveform.
+
+    Parameters
+    ----------
+
+    dims : (int, int)
+        The size of the display
+
+    tile_dims : (int, int)
+        The size of each tile. A good choice is the height of a line of text,
+        and a width that is a multiple of 4 (so cleanups don't need aligning)
+
+    threshold : int
+        How many fast refreshes a tile can get before it is due for a cleanup.
+        It can be changed for parts of the screen with set_threshold
+
+    budget : int
+        The most cleanups that cleanups() will return at once, so that they can
+        be spread out over idle time instead of blocking for a long time
+    '''
+
+    def __init__(self, dims, tile_dims, threshold=20, budget=2):
+        self.dims = dims
+        self.tile_dims = tile_dims
+        self.budget = budget
+
+        grid = (-(-dims[1] // tile_dims[1]), -(-dims[0] // tile_dims[0]))
+        self.counts = np.zeros(grid, dtype=np.int32)
+        self.thresholds = np.full(grid, threshold, dtype=np.int32)
+
+        self.cleaned = 0
+
+    def _tiles(self, box, inner=False):
+        '''
+        The slices of the tile grid that box (x0, y0, x1, y1) touches, or
+        with inner=True the ones it covers completely.
+        '''
+        width, height = self.tile_dims
+        x0, y0, x1, y1 = box
+
+        # the tiles on the edges of the display may be cut off
+        if x1 >= self.dims[0]:
+            x1 = self.counts.shape[1]*width
+        if y1 >= self.dims[1]:
+            y1 = self.counts.shape[0]*height
+
+        if inner:
+            return slice(-(-y0 // height), y1 // height), slice(-(-x0 // width), x1 // width)
+        return slice(y0 // height, -(-y1 // height)), slice(x0 // width, -(-x1 // width))
+
+    def record(self, box, mode):
+        '''
+        Account for a refresh of the area box (x0, y0, x1, y1) with the given mode.
+        '''
+        if mode in FAST_MODES:
+            self.counts[self._tiles(box)] += 1
+        elif mode in CLEAN_MODES:
+            self.counts[self._tiles(box, inner=True)] = 0
+
+    def reset(self):
+        '''
+        Call this after the whole display has been cleaned.
+        '''
+        self.counts[:] = 0
+
+    def set_threshold(self, box, threshold):
+        '''
+        Use a different threshold for the tiles touched by box (for example, a
+        status line that changes all the time can be allowed more refreshes).
+        '''
+        self.thresholds[self._tiles(box)] = threshold
+
+    def cleanups(self):
+        '''
+        Get up to budget areas to refresh with GC16, worst first, as (x0, y0, x1, y1)
+        boxes. Tiles that are due in the same row are cleaned together, along with
+        the tiles in between. Call record() for each one once it has been refreshed.
+        '''
+        due = self.counts >= self.thresholds
+        rows = np.flatnonzero(np.any(due, axis=1))
+        if not rows.size:
+            return []
+
+        # the rows with the most ghosting relative to their thresholds go first
+        excess = (self.counts - self.thresholds).max(axis=1)
+        rows = rows[np.argsort(-excess[rows], kind='stable')][:self.budget]
+
+        width, height = self.tile_dims
+        boxes = []
+        for row in rows:
+            cols = np.flatnonzero(due[row])
+            boxes.append((
+                int(cols[0])*width,
+                int(row)*height,
+                min(int(cols[-1]+1)*width, self.dims[0]),
+                min(int(row+1)*height, self.dims[1]),
+            ))
+            self.cleaned += 1
+
+        return boxes
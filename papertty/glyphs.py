@@ -0,0 +1,202 @@
+'''
+This file defines a cache of pre-rendered character cells, so that
+the terminal can paste glyphs into its frame buffer instead of asking
+FreeType to rasterize them every time a character changes.
+'''
+
+from collections import OrderedDict
+from os.path import exists
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+# the characters we render ahead of time
+PRINTABLE_ASCII = range(0x20, 0x7F)
+
+# what we draw for codepoints that can't be characters
+REPLACEMENT_CHARACTER = 0xFFFD
+
+# a codepoint that no font has a glyph for, to see what a font draws for missing ones
+NONCHARACTER = 0xFFFF
+
+# the colors of cells that can be drawn without antialiasing in mono mode
+BLACK_AND_WHITE = (0x00, 0xFF)
+
+def safe_chr(codepoint):
+    '''
+    chr(), except that surrogates and out of range values (which PIL can't draw)
+    become the replacement character.
+    '''
+    if codepoint > 0x10FFFF or 0xD800 <= codepoint < 0xE000:
+        codepoint = REPLACEMENT_CHARACTER
+    return chr(codepoint)
+
+class GlyphAtlas:
+    '''
+    An LRU cache of character cells rendered in a given font. Each entry
+    is a uint8 numpy array the size of one character cell (height, width),
+    with the glyph drawn in the foreground color on top of the background
+    color, so that it can be copied straight into the frame buffer. Runs of
+    cells can be joined with np.concatenate along the last axis.
+
+    Entries are keyed by (codepoint, bold, fg, bg). The size of the cache is
+    bounded by max_size entries, which bounds its memory too, since every entry
+    is the same size.
+
+    Characters outside of ASCII that the font doesn't have are drawn with the
+    first of fallback_fonts that does have them. The fonts at fallback_font_paths
+    (the ones that exist) are added to those the first time one is needed, since
+    most consoles never need them.
+
+    With mono=True, cells in black and white are drawn without antialiasing, so
+    that they only contain black and white pixels, and can be sent to the display
+    at 1 bit per pixel. Cells with gray in them are still antialiased.
+    '''
+
+    def __init__(self, font, bold_font, char_dims, max_size=16384, fallback_fonts=(), fallback_font_paths=(),
+                 mono=False):
+        self.font = font
+        self.bold_font = bold_font
+        self.char_dims = char_dims
+        self.max_size = max_size
+        self.fallback_fonts = list(fallback_fonts)
+        self.fallback_font_paths = list(fallback_font_paths)
+        self.mono = mono
+
+        self.tiles = OrderedDict()
+
+        # which font (and where in the cell) each non-ASCII character gets drawn with
+        self.choices = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def get(self, codepoint, bold, fg, bg):
+        '''
+        Get the image of a character cell, rendering it if we haven't already.
+        '''
+        key = (codepoint, bold, fg, bg)
+
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.hits += 1
+            self.tiles.move_to_end(key)
+            return tile
+
+        self.misses += 1
+
+        tile = Image.new('L', self.char_dims, bg)
+        font, offset = self._choose_font(codepoint, bold)
+        self._draw(tile, self._aliased(fg, bg)).text(offset, safe_chr(codepoint), font=font, fill=fg)
+
+        tile = np.asarray(tile)
+        self._insert(key, tile)
+        return tile
+
+    def warm(self, fg_colors, bg_colors, codepoints=PRINTABLE_ASCII):
+        '''
+        Render every combination of the given codepoints and colors, in both
+        regular and bold weight, ahead of time.
+        '''
+        box = (0, 0) + tuple(self.char_dims)
+
+        for bold, font in ((False, self.font), (True, self.bold_font)):
+            for codepoint in codepoints:
+
+                # rasterize the glyph once (or twice, in mono mode), and then use it
+                # as a mask to produce each of the color combinations
+                masks = {}
+                for aliased in {False, self.mono}:
+                    masks[aliased] = Image.new('L', self.char_dims, 0x00)
+                    self._draw(masks[aliased], aliased).text((0, 0), chr(codepoint), font=font, fill=0xFF)
+
+                for bg in set(bg_colors):
+                    for fg in set(fg_colors):
+                        key = (codepoint, bold, fg, bg)
+                        if key in self.tiles:
+                            continue
+
+                        tile = Image.new('L', self.char_dims, bg)
+                        tile.paste(fg, box=box, mask=masks[self._aliased(fg, bg)])
+                        self._insert(key, np.asarray(tile))
+
+    def stats(self):
+        '''
+        Get a dictionary of the cache counters.
+        '''
+        return {
+            'size': len(self.tiles),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _aliased(self, fg, bg):
+        '''
+        Whether a cell in these colors gets drawn without antialiasing.
+        '''
+        return self.mono and fg in BLACK_AND_WHITE and bg in BLACK_AND_WHITE
+
+    @staticmethod
+    def _draw(image, aliased=False):
+        draw = ImageDraw.Draw(image)
+        if aliased:
+            draw.fontmode = '1'
+        return draw
+
+    def _choose_font(self, codepoint, bold):
+        '''
+        Get the font to draw a character with, and the position to draw it at
+        so that it sits on the same baseline as the main font.
+        '''
+        font = self.bold_font if bold else self.font
+        if codepoint < 0x80 or not (self.fallback_fonts or self.fallback_font_paths):
+            return font, (0, 0)
+
+        key = (codepoint, bold)
+        choice = self.choices.get(key)
+        if choice is not None:
+            return choice
+
+        choice = font, (0, 0)
+        if not self._has_glyph(font, codepoint):
+            self._load_fallback_fonts()
+            for fallback in self.fallback_fonts:
+                offset = (0, font.getmetrics()[0] - fallback.getmetrics()[0])
+                if self._has_glyph(fallback, codepoint, offset):
+                    choice = fallback, offset
+                    break
+
+        # this is only a shortcut, so rather than keeping track of what's least
+        # recently used, just start over when it gets big
+        if len(self.choices) >= self.max_size:
+            self.choices.clear()
+        self.choices[key] = choice
+        return choice
+
+    def _load_fallback_fonts(self):
+        for path in self.fallback_font_paths:
+            if exists(path):
+                self.fallback_fonts.append(ImageFont.truetype(path, self.font.size))
+        self.fallback_font_paths = []
+
+    def _has_glyph(self, font, codepoint, offset=(0, 0)):
+        '''
+        Whether font has a glyph for codepoint, rather than drawing the box it
+        draws for missing characters. PIL doesn't tell us, so we compare them.
+        '''
+        def draw(char):
+            mask = Image.new('L', self.char_dims, 0x00)
+            ImageDraw.Draw(mask).text(offset, char, font=font, fill=0xFF)
+            return mask.tobytes()
+
+        return draw(safe_chr(codepoint)) != draw(chr(NONCHARACTER))
+
+    def _insert(self, key, tile):
+        self.tiles[key] = tile
+        if len(self.tiles) > self.max_size:
+            self.tiles.popitem(last=False)
+            self.evictions += 1
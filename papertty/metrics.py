@@ -0,0 +1,236 @@
+'''
+This file keeps timings and counts of what PaperTTY is doing, cheaply enough
+to leave on all the time, and exports them in the Prometheus text format, to
+a file or to anyone who connects to a Unix socket.
+
+For example, with PaperTTY running with --metrics-socket /tmp/papertty_metrics:
+
+    socat - UNIX-CONNECT:/tmp/papertty_metrics
+'''
+
+import os
+import socket
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from time import perf_counter
+
+from .waveform import MODE_NAMES
+
+# in seconds. the panel takes anywhere from ~100ms to a couple of seconds to refresh,
+# everything else should be well under a frame
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+class Histogram:
+    '''
+    Counts observations (usually durations, in seconds) in buckets.
+    '''
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.counts = [0]*(len(self.buckets)+1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        '''
+        A context manager that observes how long its block takes.
+        '''
+        return Timer(self)
+
+    def export(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.description),
+            '# TYPE {} histogram'.format(self.name),
+        ]
+
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound, total))
+
+        lines.append('{}_sum {}'.format(self.name, self.sum))
+        lines.append('{}_count {}'.format(self.name, self.count))
+        return lines
+
+class Timer:
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(perf_counter() - self.start)
+
+class Counter:
+    '''
+    A count of something, optionally split up by the value of a label.
+    '''
+
+    def __init__(self, name, description, label=None):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.values = OrderedDict()
+
+    def inc(self, amount=1, label_value=None):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def export(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.description),
+            '# TYPE {} counter'.format(self.name),
+        ]
+
+        if self.label is None:
+            lines.append('{} {}'.format(self.name, self.values.get(None, 0)))
+        else:
+            for value, count in self.values.items():
+                lines.append('{}{{{}="{}"}} {}'.format(self.name, self.label, value, count))
+        return lines
+
+class Metrics:
+    '''
+    A collection of histograms and counters. Asking for one that already exists
+    returns the existing one, so that several parts of the program can share a
+    Metrics instance without coordinating.
+
+    Parameters
+    ----------
+
+    prefix : str
+        Prepended to the name of every metric
+    '''
+
+    def __init__(self, prefix='papertty_'):
+        self.prefix = prefix
+        self.metrics = OrderedDict()
+        self.server = None
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, description, buckets)
+
+    def counter(self, name, description, label=None):
+        return self._get(Counter, name, description, label)
+
+    def _get(self, cls, name, *args):
+        name = self.prefix + name
+        if name not in self.metrics:
+            self.metrics[name] = cls(name, *args)
+        return self.metrics[name]
+
+    def export(self):
+        '''
+        Get all of the metrics in the Prometheus text format.
+        '''
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.export())
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        '''
+        Write the metrics to a file, replacing it all at once so that a reader
+        never sees half of it.
+        '''
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.export())
+        os.replace(tmp_path, path)
+
+    def serve(self, path):
+        '''
+        Listen on a Unix socket at path, and send the metrics to anyone who
+        connects, on a background thread.
+        '''
+        if os.path.exists(path):
+            os.remove(path)
+
+        # so that it can be scraped without root
+        old_umask = os.umask(0)
+        try:
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(path)
+        finally:
+            os.umask(old_umask)
+
+        self.server_path = path
+        self.server.listen(4)
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return  # closed
+
+            with conn:
+                try:
+                    conn.sendall(self.export().encode())
+                except OSError:
+                    pass
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            os.remove(self.server_path)
+            self.server = None
+
+class InstrumentedSPI:
+    '''
+    Wraps the EPD's SPI interface to time the pixel transfers that don't go
+    through load_img_area.
+    '''
+
+    def __init__(self, spi, upload_time):
+        self._spi = spi
+        self._upload_time = upload_time
+
+    def __getattr__(self, name):
+        return getattr(self._spi, name)
+
+    def write_pixels(self, *args, **kwargs):
+        with self._upload_time.time():
+            return self._spi.write_pixels(*args, **kwargs)
+
+class InstrumentedEPD:
+    '''
+    Wraps an IT8951 EPD, timing how long sending pixels and waiting for the
+    panel take, and counting refreshes by waveform mode. Everything else is
+    passed through to the EPD.
+    '''
+
+    def __init__(self, epd, metrics):
+        self._epd = epd
+        self._upload_time = metrics.histogram('spi_upload_seconds', 'Time spent sending pixels to the controller')
+        self._wait_time = metrics.histogram('panel_wait_seconds', 'Time spent waiting for the panel to be ready')
+        self._refreshes = metrics.counter('refreshes_total', 'Display refreshes by waveform mode', label='mode')
+
+        self.spi = InstrumentedSPI(epd.spi, self._upload_time)
+
+    def __getattr__(self, name):
+        return getattr(self._epd, name)
+
+    def load_img_area(self, *args, **kwargs):
+        with self._upload_time.time():
+            return self._epd.load_img_area(*args, **kwargs)
+
+    def wait_display_ready(self):
+        with self._wait_time.time():
+            return self._epd.wait_display_ready()
+
+    def display_area(self, xy, dims, mode):
+        self._refreshes.inc(label_value=MODE_NAMES.get(mode, mode))
+        return self._epd.display_area(xy, dims, mode)
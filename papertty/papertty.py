@@ -1,49 +1,259 @@
 
-import cProfile, io, pstats
+from time import perf_counter
+STARTED = perf_counter()  # so that we can tell how long it takes to get going
+
 import signal
-from time import sleep, perf_counter
+import threading
+import numpy as np
 from os.path import dirname, join
 
 from IT8951 import constants
-from IT8951.interface import EPD
 from IT8951.display import AutoEPDDisplay
 
-from .render import Terminal
-from .vcsa import auto_resize_tty, read_vcsa
+from .render import Terminal, shared_frame, FG_COLOR_MAP, BG_COLOR_MAP
+from .planner import RefreshPlanner, stronger_mode, box_union, boxes_overlap
+from .ghosting import GhostTracker
+from .burst import BurstDetector
+from .waveform import WaveformPolicy, AUTO_MODE, black_and_white
+from .metrics import Metrics, InstrumentedEPD
+from .pixels import BPP_FOR_MODE, pixel_alignment, pack
+from .vcsa import auto_resize_tty, VcsaReader, VcsaWaiter, ActiveVT
 from .controller import Controller
 
 from PIL import Image
 
+def merge_dirty(dirty):
+    '''
+    Merge a list of (box, gray) regions, as in Terminal.dirty, into one.
+    '''
+    box, gray = dirty[0]
+    for other_box, other_gray in dirty[1:]:
+        box = box_union(box, other_box)
+        gray = gray or other_gray
+    return box, gray
+
 class Runner:
 
-    def __init__(self, profile=False, ttyn=1, frame_rate=10, flip=False):
+    def __init__(self, profile=False, ttyn=1, frame_rate=10, flip=False, cost_model=None, idle_interval=0.5,
+                 ghost_threshold=20, cleanup_budget=2, cleanup_delay=2, full_cleanup_interval=None,
+                 policy=None, follow_ttys=None, unicode=False, metrics_path=None, metrics_socket=None,
+                 max_pending=256, cursor_rows=1, max_defer=1,
+                 burst_rate=2000, burst_scroll_frames=5, burst_settle_time=1, burst_summary_interval=2,
+                 state_path=None, state_interval=60, mono=False, epd=None):
 
-        self.ttyn = ttyn
         self.inv_frame_rate = 1/frame_rate
+
+        # timings and counts, which are always kept. they get written to metrics_path
+        # (at most once a second) and/or sent to anyone connecting to metrics_socket
+        self.metrics = Metrics()
+        self.metrics_path = metrics_path
+        self.last_metrics_write = 0
+        if metrics_socket is not None:
+            self.metrics.serve(metrics_socket)
+
+        self.read_time = self.metrics.histogram('vcsa_read_seconds', 'Time spent reading the console')
+        self.frame_time = self.metrics.histogram('frame_seconds', 'Time from reading a changed console to displaying it')
+        self.frames = self.metrics.counter('frames_total', 'Frames in which the console had changed')
+        self.cells_changed = self.metrics.counter('cells_changed_total', 'Characters that were drawn')
+        self.first_frame_time = self.metrics.histogram('first_frame_seconds',
+                                                       'Time from starting up to showing the console',
+                                                       buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25))
+        self.dropped_frames = self.metrics.counter('dropped_frames_total',
+                                                   'Frames that took longer than the frame interval')
+        self.restore_time = self.metrics.histogram('restore_seconds',
+                                                   'Time spent redrawing the terminal after another process '
+                                                   'took over the display')
+        self.restored_pixels = self.metrics.counter('restored_pixels_total',
+                                                    'Pixels redrawn after another process took over the display')
+        self.cursor_latency = self.metrics.histogram('cursor_latency_seconds',
+                                                     'Time from reading a change near the cursor to refreshing it')
+
+        # if we're given a list of ttys, we show whichever of them is in the foreground
+        # (and stay on the last one while some other console is)
+        self.ttys = [ttyn] if follow_ttys is None else list(follow_ttys)
+        self.active_vt = None if follow_ttys is None else ActiveVT()
+        if self.active_vt is not None and self.active_vt.read() in self.ttys:
+            ttyn = self.active_vt.read()
+        self.ttyn = ttyn
+
+        # whether to read the real characters from /dev/vcsu, rather than the console font's 8-bit ones
+        self.unicode = unicode
+
+        # keep each console open and read it into preallocated buffers. all we keep for the
+        # ttys that aren't being shown is their text, in their readers; when we switch to one
+        # the terminal redraws the characters that differ from what's on the screen
+        self.readers = {ttyn: VcsaReader(ttyn, unicode=unicode)}
+
+        # wakes us up when the console changes (or the user switches consoles). frame_rate is
+        # the most frames per second we'll render, idle_interval the longest we'll sleep without checking
+        self.waiter = VcsaWaiter(
+            ttyn,
+            min_interval=self.inv_frame_rate,
+            max_interval=idle_interval,
+            watch=() if self.active_vt is None else (self.active_vt.fd,),
+        )
+
         self.profile = profile
         if self.profile:
+            import cProfile
             self.pr = cProfile.Profile()
 
+        # chooses the waveform mode for each refresh from what's being displayed
+        self.policy = WaveformPolicy() if policy is None else policy
+
         # keep track of two displays: one for the terminal, the other for when
-        # processes want to take it over
-        epd = EPD(vcom=-1.78)
+        # processes want to take it over. they share the panel, which is the real one
+        # unless we're given another (like a SimulatedEPD)
+        if epd is None:
+            from IT8951.interface import EPD
+            epd = EPD(vcom=-1.78)
+            self.sim = None
+        else:
+            from .sim import SimulatedEPD
+            self.sim = epd if isinstance(epd, SimulatedEPD) else None
+        epd = InstrumentedEPD(epd, self.metrics)
         self.term_display = AutoEPDDisplay(epd, flip=flip)
-        self.controller_display = Controller(epd, flip=flip)
-
-        print('Initializing...')
-        self.term_display.clear()
+        self.flip = flip
+
+        # the glyphs get rendered ahead of time once the first frame is out of the way. in mono mode,
+        # text in the default colors is drawn in pure black and white, so that it can be sent to
+        # the display at 1 bit per pixel
+        self.term = Terminal((self.term_display.width, self.term_display.height), frame_buf=self.term_display.frame_buf,
+                             warm_glyphs=False, mono=mono, metrics=self.metrics)
+
+        # what the panel is showing (in the panel's orientation), so that the policy
+        # can take the previous pixels into account. the controller keeps it up to date
+        # when other processes use the display
+        self.shown = np.full((self.term_display.height, self.term_display.width), 0xFF, dtype=np.uint8)
+
+        # we save what the terminal and the panel are showing to state_path when we exit, and
+        # every state_interval seconds. if we exited cleanly last time, the panel is still showing
+        # what we saved, so we can start from there, rather than clearing it and drawing everything
+        self.state_path = state_path
+        self.state_interval = state_interval
+        self.last_state_save = perf_counter()
+        state = None
+        if state_path is not None:
+            from .state import terminal_config, load_state
+            self.state_config = terminal_config(self.term, (self.term_display.width, self.term_display.height),
+                                                flip, unicode)
+            state = load_state(state_path, self.state_config)
+
+        if state is not None:
+            self.term.restore(state['cursor_pos'], state['data'], state['pixels'])
+
+        if state is not None and state['clean']:
+            print('Picking up where we left off...')
+            self.shown[:] = state['shown']
+        else:
+            print('Initializing...')
+            self.term_display.clear()
+
+        # the terminal is rendered on the main thread, and sent to the display on another one, so
+        # that we can keep reading and rendering the console while the panel refreshes. the display
+        # thread works from its own copy of the terminal's pixels, which it takes (along with the
+        # regions that changed since it last did) while holding self.lock. the main thread holds
+        # the lock while it renders, so the copy never has half of a frame in it
+        self.frame = self.term.pixels.copy()
+        self.term_display.frame_buf = shared_frame(self.frame)
+
+        self.lock = threading.Condition()
+        self.pending = []            # regions that changed, which the display thread hasn't taken yet
+        self.pending_since = None    # when the oldest of them was read
+        self.started = STARTED       # until the console has been shown for the first time
+        self.first_update_done = False
+        self.max_pending = max_pending
+        self.idle_interval = idle_interval
+
+        # other processes can open windows on the display, which get drawn over the terminal by the
+        # display thread, and refreshed along with it. or they can take over the whole display, in
+        # which case the display thread lets the controller show what they send until they're done,
+        # while the main thread keeps rendering the console
+        self.controller_display = Controller(epd, flip=flip, policy=self.policy, shown=self.shown,
+                                             metrics=self.metrics, on_update=self.wake_display)
+
+        # what's being typed gets to the display first: changes within cursor_rows lines of
+        # the cursor are refreshed on their own (so they stay in the fast waveforms), and the
+        # rest of the screen waits while they keep coming, for up to max_defer seconds
+        self.cursor_rows = cursor_rows
+        self.max_defer = max_defer
+        self.deferred_since = None
+
+        # decides how the changes of each frame get sent to the display
+        self.planner = RefreshPlanner((self.term_display.width, self.term_display.height), cost_model=cost_model)
+
+        # keeps track of where the fast refreshes have left ghosting, one tile per line of
+        # text. after cleanup_delay seconds without changes, up to cleanup_budget of the
+        # worst areas get cleaned up each time we wake up. the full screen gets cleaned
+        # every full_cleanup_interval seconds (if set), or when we get SIGUSR1
+        self.ghosts = GhostTracker(
+            (self.term_display.width, self.term_display.height),
+            (128, self.term.char_dims[1]),
+            threshold=ghost_threshold,
+            budget=cleanup_budget,
+        )
+        self.cleanup_delay = cleanup_delay
+        self.full_cleanup_interval = full_cleanup_interval
+        self.full_cleanup_requested = False
+        self.last_full_cleanup = perf_counter()
+
+        # notices when the console is changing too fast to be worth showing every frame of
+        # (burst_rate characters per second, or burst_scroll_frames frames in a row that
+        # scrolled), and then only shows it every burst_summary_interval seconds, plus a
+        # clean refresh once it hasn't changed for burst_settle_time seconds
+        self.burst = BurstDetector(
+            rate=burst_rate,
+            scroll_frames=burst_scroll_frames,
+            settle_time=burst_settle_time,
+            summary_interval=burst_summary_interval,
+            metrics=self.metrics,
+        )
 
-        self.term = Terminal((self.term_display.width, self.term_display.height), frame_buf=self.term_display.frame_buf)
+        # whatever the panel doesn't show yet of a restored terminal image. it's marked as gray, since
+        # it's probably replacing the penguin, which the black and white waveforms would leave a ghost of
+        restored = self._shown((0, 0, self.term_display.width, self.term_display.height)) != self.term.pixels
+        if restored.any():
+            ys, xs = np.nonzero(restored)
+            with self.lock:
+                self.hand_off([((int(xs.min()), int(ys.min()), int(xs.max())+1, int(ys.max())+1), True)], STARTED)
 
-        auto_resize_tty(self.ttyn, self.term.char_dims, (self.term_display.width, self.term_display.height))
+        for tty in self.ttys:
+            auto_resize_tty(tty, self.term.char_dims, (self.term_display.width, self.term_display.height))
 
         # handle both of these the same way
         signal.signal(signal.SIGTERM, self.sigterm_handler)
         signal.signal(signal.SIGINT, self.sigterm_handler)
 
+        signal.signal(signal.SIGUSR1, self.sigusr1_handler)
+
+    @property
+    def reader(self):
+        return self.readers[self.ttyn]
+
+    def follow_active_vt(self):
+        '''
+        If we're following the active console and it has changed to one of ours,
+        switch to it. Returns whether we switched.
+        '''
+        if self.active_vt is None:
+            return False
+
+        ttyn = self.active_vt.read()
+        if ttyn == self.ttyn or ttyn not in self.ttys:
+            return False
+
+        self.ttyn = ttyn
+        if ttyn not in self.readers:
+            self.readers[ttyn] = VcsaReader(ttyn, unicode=self.unicode)
+        self.waiter.switch(ttyn)
+        return True
+
     def sigterm_handler(self, sig=None, frame=None):
         self.running = False
 
+    def sigusr1_handler(self, sig=None, frame=None):
+        self.full_cleanup_requested = True
+
     def on_exit(self):
         '''
         Some things to do when we exit cleanly. We don't want to do them when we are not exiting cleanly,
@@ -52,73 +262,486 @@ class Runner:
 
         print('Exiting...')
 
+        print('glyph cache: {size} cells, {hits} hits, {misses} misses, {evictions} evictions'.format(
+            **self.term.glyphs.stats()
+        ))
+        print('scrolling: {} scrolls, {} characters moved instead of drawn'.format(
+            self.term.scrolls, self.term.scroll_cells_saved
+        ))
+        print('ghosting: {} areas cleaned up'.format(self.ghosts.cleaned))
+        print('bursts: {} bursts of output, {} frames skipped'.format(self.burst.bursts, self.burst.skipped))
+        print('waveforms: ' + ', '.join(
+            '{} {}'.format(name, count) for name, count in self.policy.stats().items() if count
+        ))
+
+        self.export_metrics(force=True)
+        self.metrics.close()
+
         if self.profile:
+            import io, pstats
             s = io.StringIO()
             ps = pstats.Stats(self.pr, stream=s).sort_stats('cumulative')
             ps.print_stats()
             print(s.getvalue())
 
         self.display_penguin()
+        self.save_state(clean=True)
 
-    def update_callback(self, need_gray):
+        # so that the next start doesn't find the controller's files still there
+        self.controller_display.close()
+
+        if self.sim is not None:
+            print(self.sim.report())
+
+    def hand_off(self, dirty, read_time):
         '''
-        This function gets called whenever a character gets updated
-        by term, in order to get quick updates on the screen
+        Give the regions that changed in the last update to the display thread. Call
+        with self.lock held. If the display is falling behind, the regions get merged,
+        so that they don't pile up.
         '''
-        if need_gray:
-            self.term_display.draw_partial(constants.DisplayModes.GL16)
-        else:
-            self.term_display.draw_partial(constants.DisplayModes.DU)
+        if not dirty:
+            return
 
-    def update(self):
+        self.pending.extend(dirty)
+        if self.pending_since is None:
+            self.pending_since = read_time
+
+        if len(self.pending) > self.max_pending:
+            self.pending = [merge_dirty(self.pending)]
+
+        self.lock.notify_all()
+
+    def display_loop(self):
+        '''
+        The display thread: send changes to the display as they come in, and clean up
+        ghosting when there aren't any.
+        '''
+        while True:
+            with self.lock:
+                self.lock.wait_for(
+                    lambda: not self.display_running or self.pending or self.full_cleanup_requested or
+                            self.controller_display.has_updates() or self.controller_display.takeover_requested(),
+                    timeout=self.idle_interval,
+                )
+
+                if not self.display_running and not self.pending:
+                    return
+
+                takeover = self.controller_display.check_active()
+                if not takeover:
+                    dirty, self.pending = self.pending, []
+                    since, self.pending_since = self.pending_since, None
+                    cursor_pos = self.term.cursor_pos
+                    updates, damage = self.controller_display.take_updates()
+                    if dirty or updates or damage or self.full_cleanup_requested:
+                        np.copyto(self.frame, self.term.pixels)
+                        self.controller_display.compose(self.frame)
+
+                    # where windows have closed, whatever was under them needs to be shown
+                    # again, and the terminal knows whether its part of that is gray
+                    damage = [(box, self.term.gray(box)) for box in damage]
+
+            if takeover:
+                # another process has taken over the display. what changes on the console
+                # meanwhile piles up in self.pending, and gets shown once it's done
+                self.controller_display.run()
+                self.restore_display()
+                continue
+
+            if self.full_cleanup_requested:
+                self.full_cleanup()  # which shows all of the changes anyway
+            elif dirty or updates or damage:
+                # the terminal only shows where there aren't any windows
+                dirty = [(rect, gray) for box, gray in dirty for rect in self.controller_display.uncovered(box)]
+                dirty.extend(damage)
+                requested = [(rect, update['mode'], update['bpp']) for update in updates for rect in update['rects']]
+                self.flush(dirty, cursor_pos, since, requested)
+            else:
+                self.clean_up()
+
+            self.controller_display.ack(updates)
+
+            if self.started is not None and self.first_update_done and not self.pending:
+                elapsed = perf_counter() - self.started
+                self.first_frame_time.observe(elapsed)
+                print('Showing the console after {:.2f}s'.format(elapsed))
+                self.started = None
+
+    def wake_display(self):
+        '''
+        Wake the display thread up, because there's something new for it to do.
+        '''
+        with self.lock:
+            self.lock.notify_all()
+
+    def flush(self, dirty, cursor_pos=None, since=None, requested=()):
+        '''
+        Send the regions of the terminal that changed to the display, the ones near
+        the cursor first (along with any updates from windows). The rest are put back
+        to be sent along with the next changes if more have already come in (up to
+        max_defer seconds after they were first put back), so that typing isn't held
+        up by the rest of the screen.
+
+        Parameters
+        ----------
+
+        dirty : list
+            (box, gray) pairs, as in Terminal.dirty
+
+        cursor_pos : (int, int), optional
+            The text coordinates of the cursor
+
+        since : float, optional
+            The perf_counter() time that the oldest of the changes was read
+
+        requested : list
+            (box, mode, bpp) that other processes asked to have refreshed, where the
+            mode may be AUTO_MODE, and bpp is the bits per pixel they asked for the
+            pixels to be sent to the panel at
+        '''
+        urgent, rest = self.prioritize(dirty, cursor_pos)
+
+        if (urgent or requested) and self.send(urgent, requested) and urgent and since is not None:
+            self.cursor_latency.observe(perf_counter() - since)
+
+        if not rest:
+            self.deferred_since = None
+            return
+
+        now = perf_counter()
+        if self.deferred_since is None:
+            self.deferred_since = now
+
+        if now - self.deferred_since < self.max_defer:
+            with self.lock:
+                if self.pending:
+                    self.pending[:0] = rest
+                    return
+
+        self.deferred_since = None
+        self.send(rest)
+
+    def prioritize(self, dirty, cursor_pos):
+        '''
+        Split dirty into the regions within cursor_rows lines of the cursor, and the rest.
+        '''
+        if cursor_pos is None:
+            return [], dirty
+
+        height = self.term.char_dims[1]
+        top = (cursor_pos[1] - self.cursor_rows)*height
+        bottom = (cursor_pos[1] + self.cursor_rows + 1)*height + 1  # the cursor is drawn below its line
+
+        urgent, rest = [], []
+        for box, gray in dirty:
+            if box[1] < bottom and box[3] > top:
+                urgent.append((box, gray))
+            else:
+                rest.append((box, gray))
+        return urgent, rest
+
+    def send(self, dirty, requested=()):
+        '''
+        Refresh the regions in dirty (and requested, as in flush), using as few refreshes
+        as the planner thinks is worthwhile. Returns how many refreshes it took.
+        '''
+        rects = []
+        for box, gray in dirty:
+            mode = self.policy.classify(self._frame(box), self._shown(box))
+            if mode is None:
+                continue
+
+            # the terminal knows for sure when there are gray colors, which might
+            # be too few pixels for the policy to notice (a gray '.', say)
+            if gray:
+                mode = stronger_mode(mode, constants.DisplayModes.GL16)
+            rects.append((box, mode))
+
+        # the policy only chooses for the terminal and for AUTO_MODE requests. other processes
+        # can ask for a particular mode (say, GC16 to clean up), which they get even if nothing changed
+        chosen = [box for box, _ in rects]
+        explicit = []
+        for box, mode, _ in requested:
+            if mode == AUTO_MODE:
+                mode = self.policy.classify(self._frame(box), self._shown(box))
+                if mode is None:
+                    continue
+                chosen.append(box)
+            else:
+                explicit.append(box)
+            rects.append((box, mode))
+
+        refreshes = 0
+        for box, mode in self.planner.plan(rects):
+            if any(boxes_overlap(box, other) for other in chosen):
+                # a merged area can include pixels that weren't in any of the rectangles
+                selected = self.policy.select(self._frame(box), self._shown(box), at_least=mode)
+                if selected is None and any(boxes_overlap(box, other) for other in explicit):
+                    selected = mode
+                mode = selected
+
+            if mode is not None:
+                # other processes' pixels get sent with at least as many bits as they asked for
+                bpp = max((bpp for other, _, bpp in requested if boxes_overlap(box, other)), default=None)
+                self.display_box(box, mode, bpp)
+                refreshes += 1
+        return refreshes
+
+    def _frame(self, box):
+        '''
+        The pixels of the display thread's copy of the frame buffer in box (x0, y0, x1, y1).
+        '''
+        return self.frame[box[1]:box[3], box[0]:box[2]]
+
+    def _shown(self, box):
+        '''
+        The pixels the panel currently shows for box (x0, y0, x1, y1), in the
+        frame buffer's orientation.
+        '''
+        if self.flip:
+            width, height = self.term_display.width, self.term_display.height
+            return self.shown[height-box[3]:height-box[1], width-box[2]:width-box[0]][::-1, ::-1]
+        return self.shown[box[1]:box[3], box[0]:box[2]]
+
+    def _panel_box(self, box):
         '''
-        Update the contents of the display
+        Where box (x0, y0, x1, y1) of the frame buffer is on the panel.
         '''
+        if self.flip:
+            width, height = self.term_display.width, self.term_display.height
+            return (width-box[2], height-box[3], width-box[0], height-box[1])
+        return box
 
-        # if another process has decided to take the display, do that
-        if self.controller_display.check_active():
-            self.controller_display.run()
-            self.term_display.draw_full(constants.DisplayModes.GC16)  # get our terminal back
+    def display_box(self, box, mode, bpp=None):
+        '''
+        Update the area box (x0, y0, x1, y1) of the display from the frame buffer.
+        The pixels are sent packed (at no fewer than bpp bits per pixel, if given)
+        through the controller, so that sending them can overlap with the refresh
+        the panel is still doing.
+        '''
+        self.ghosts.record(box, mode)
+        self._shown(box)[:] = self._frame(box)
+
+        (x0, y0, x1, y1), bpp = self._packing(self._panel_box(box), mode, bpp)
+        pixels = self.shown[y0:y1, x0:x1]
+        self.controller_display.refresh(pack(pixels, bpp), (x0, y0), (x1-x0, y1-y0), mode, bpp)
+
+    def _packing(self, panel_box, mode, bpp=None):
+        '''
+        Choose how to send an area of the panel: at the fewest bits per pixel (and at
+        least bpp) that show what's there with the mode, and widened to whole 16-bit
+        words, as packed transfers need. We send what the panel already shows in the
+        extra pixels, so refreshing them does nothing, unless they're gray and the mode
+        only shows black and white. Then the area is sent as it is, at 8 bits per pixel.
+        '''
+        x0, y0, x1, y1 = panel_box
+        bpp = max(BPP_FOR_MODE.get(mode, 8), bpp or 1)
+
+        def widened(bpp):
+            align = pixel_alignment(bpp)
+            return x0 - x0 % align, -(-x1 // align)*align
+
+        wide_x0, wide_x1 = widened(bpp)
+        if bpp == 1 and not black_and_white(self.shown[y0:y1, wide_x0:wide_x1]):
+            # 1bpp is only for black and white, but the panel has 16 gray levels, so 4 bits
+            # show everything 8 would
+            bpp = 4
+            wide_x0, wide_x1 = widened(bpp)
+
+        if wide_x1 > self.term_display.width:
+            return panel_box, 8
+        if BPP_FOR_MODE.get(mode) == 1 and not (black_and_white(self.shown[y0:y1, wide_x0:x0]) and
+                                                black_and_white(self.shown[y0:y1, x1:wide_x1])):
+            return panel_box, 8
+        return (wide_x0, y0, wide_x1, y1), bpp
+
+    def update(self):
+        '''
+        Update the contents of the display. Returns the number of characters changed.
+        '''
 
         # currently just want to profile the updates done here
         if self.profile:
             self.pr.enable()
 
-        cursor_pos, data = read_vcsa(self.ttyn)
-        changed = self.term.update(cursor_pos, data, callback=self.update_callback)
+        switched = self.follow_active_vt()
+
+        start = perf_counter()
+        cursor_pos, data = self.reader.read()
+        self.read_time.observe(perf_counter() - start)
+
+        if self.reader.unchanged and not switched:
+            changed = 0
+
+            if self.burst.active and self.burst.settled(start):
+                # the output has stopped, so show where it ended up with a clean refresh
+                with self.lock:
+                    self.term.update(cursor_pos, data)
+                    self.full_cleanup_requested = True
+                    self.lock.notify_all()
+
+        elif self.burst.active and not switched and not self.burst.summary_due(start):
+            self.burst.skip(start)
+            self.last_change = start
+            changed = 0
+
+        else:
+            with self.lock:
+                changed = self.term.update(cursor_pos, data)
+
+                if self.burst.active:
+                    self.burst.summarized(start)
+                    if self.term.dirty:
+                        self.hand_off([merge_dirty(self.term.dirty)], start)
+                else:
+                    self.hand_off(self.term.dirty, start)
+                    self.burst.observe(start, changed, self.term.last_scroll is not None)
+
+                if self.burst.active:
+                    # we won't be drawing every frame, and the reader reuses its buffers,
+                    # so the terminal needs its own copy of what it last drew
+                    self.term.data = self.term.data.copy()
+
+            elapsed = perf_counter() - start
+            self.frame_time.observe(elapsed)
+            self.frames.inc()
+            self.cells_changed.inc(changed)
+            if elapsed > self.inv_frame_rate:
+                self.dropped_frames.inc()
+
+        if not self.first_update_done:
+            with self.lock:
+                self.first_update_done = True
+                self.lock.notify_all()
 
         if self.profile:
             self.pr.disable()
 
         if changed:
             self.last_change = perf_counter()
-            self.need_update = True
-        elif self.need_update and perf_counter() - self.last_change > 10:
-            # if it's been long time, clear out the ghosting
-            self.term_display.draw_full(constants.DisplayModes.GC16)
-            self.need_update = False
+
+        return changed
+
+    def restore_display(self):
+        '''
+        Redraw the areas that another process wrote to while it had the display. This
+        runs on the display thread.
+        '''
+        start = perf_counter()
+
+        # the transform from the panel's orientation to ours is its own inverse
+        boxes = [self._panel_box(box) for box in self.controller_display.session_boxes]
+
+        # gray left behind by the other process needs a grayscale waveform to clear it. GL16
+        # does that without flashing, and black and white can be cleared with DU. so does
+        # gray in the terminal we're putting back, which only the terminal knows for sure of
+        with self.lock:
+            np.copyto(self.frame, self.term.pixels)
+            self.controller_display.compose(self.frame)
+            dirty = [(box, self.term.gray(box) or not black_and_white(self._shown(box))) for box in boxes]
+
+        self.send(dirty)
+
+        # the boxes can overlap, so count each pixel once
+        restored = np.zeros((self.term_display.height, self.term_display.width), dtype=bool)
+        for box in boxes:
+            restored[box[1]:box[3], box[0]:box[2]] = True
+        area = int(np.count_nonzero(restored))
+
+        elapsed = perf_counter() - start
+        self.restore_time.observe(elapsed)
+        self.restored_pixels.inc(area)
+        print('Display session: {} updates; restored {} pixels ({:.0%} of the display) in {:.2f}s'.format(
+            self.controller_display.session_updates, area, area/restored.size, elapsed
+        ))
+
+    def clean_up(self):
+        '''
+        Clear out ghosting while the terminal is idle. This does a little at a time,
+        so that we're never stuck doing a long refresh when the user starts typing.
+        '''
+        now = perf_counter()
+
+        if self.full_cleanup_requested:
+            self.full_cleanup()
+        elif self.full_cleanup_interval is not None and self.ghosts.counts.any() \
+                and now - self.last_full_cleanup > self.full_cleanup_interval:
+            self.full_cleanup()
+        elif now - self.last_change > self.cleanup_delay:
+            for box in self.ghosts.cleanups():
+                self.display_box(box, constants.DisplayModes.GC16)
+
+    def full_cleanup(self):
+        '''
+        Refresh the whole display with GC16.
+        '''
+        self.display_box((0, 0, self.term_display.width, self.term_display.height), constants.DisplayModes.GC16)
+        self.ghosts.reset()
+        self.full_cleanup_requested = False
+        self.last_full_cleanup = perf_counter()
 
     def run(self):
         print('Running...')
         self.running = True
-        self.need_update = False
+        self.last_change = perf_counter()
 
-        # TODO: it would be cool to trigger events off of changes
-        # rather than just polling this file all the time. not sure
-        # if there's a good way to do that
+        self.display_running = True
+        display_thread = threading.Thread(target=self.display_loop, daemon=True)
+        display_thread.start()
 
-        while self.running:
+        try:
+            self.update()
+            self.term.glyphs.warm(FG_COLOR_MAP, BG_COLOR_MAP)
+
+            while self.running:
+                changed = self.update()
+
+                # sleep until the console changes (or it's time to check on things anyway)
+                self.waiter.feedback(changed)
+                self.export_metrics()
+                self.save_state()
+                self.waiter.wait()
+        finally:
+            # let the display thread finish what it has, and stop
+            with self.lock:
+                self.display_running = False
+                self.lock.notify_all()
+            display_thread.join()
 
-            loop_start = perf_counter()
+        self.on_exit()
 
-            self.update()
+    def export_metrics(self, force=False):
+        '''
+        Write the metrics file, if we have one and haven't written it for a second.
+        '''
+        if self.metrics_path is None:
+            return
 
-            # sleep for less time if the update took a while
-            sleep_time = self.inv_frame_rate - (perf_counter() - loop_start)
-            if sleep_time > 0:
-                sleep(sleep_time)
+        now = perf_counter()
+        if force or now - self.last_metrics_write > 1:
+            self.metrics.write(self.metrics_path)
+            self.last_metrics_write = now
 
-        self.on_exit()
+    def save_state(self, clean=False):
+        '''
+        Save what the terminal and the panel are showing, if we have a state file and
+        haven't saved it in state_interval seconds (or clean is set, for when we exit).
+        '''
+        if self.state_path is None or self.term.data is None:
+            return
+
+        now = perf_counter()
+        if not clean and (now - self.last_state_save < self.state_interval or self.last_change < self.last_state_save):
+            return
+
+        from .state import save_state
+
+        with self.lock:
+            try:
+                save_state(self.state_path, self.state_config, self.term, self.shown, clean)
+            except OSError as e:
+                print('Could not save state to {}: {}'.format(self.state_path, e))
+        self.last_state_save = now
 
     def display_penguin(self):
         '''
@@ -145,4 +768,4 @@ class Runner:
         )
         self.term_display.frame_buf.paste(img, paste_coords)
 
-        self.term_display.draw_full(constants.DisplayModes.GC16)
+        self.display_box(img_bounds, constants.DisplayModes.GC16)
@@ -0,0 +1,151 @@
+'''
+This file deals with packing pixels at less than 8 bits per pixel, and
+getting packed pixels onto the IT8951.
+
+Waveforms like DU and A2 can only show black and white, and GL16/GC16 only
+use 16 gray levels, so sending 8 bits for each pixel wastes most of the
+bandwidth (both through the controller's pipes and over SPI).
+
+Packed pixels are stored the way the IT8951 reads them with a little-endian
+image load: the first pixel goes in the lowest bits of each byte, and rows
+are packed back to back. That only works if every row is a whole number of
+16-bit words, which is what pixel_alignment() is for.
+'''
+
+import numpy as np
+from IT8951.constants import DisplayModes, PixelModes, EndianTypes, Rotate
+
+# how many bits per pixel are worth sending for each mode
+BPP_FOR_MODE = {
+    DisplayModes.INIT: 4,
+    DisplayModes.DU: 1,
+    DisplayModes.A2: 1,
+    DisplayModes.DU4: 2,
+    DisplayModes.GL16: 4,
+    DisplayModes.GLR16: 4,
+    DisplayModes.GLD16: 4,
+    DisplayModes.GC16: 4,
+}
+
+SUPPORTED_BPP = (1, 2, 4, 8)
+
+# IT8951 display registers for 1bpp mode
+UP1SR = 0x1138  # update parameter setting register 1
+BGVR = 0x1250   # bitmap (1bpp) gray values: foreground in the high byte, background in the low byte
+
+def pixel_alignment(bpp):
+    '''
+    The IT8951 transfers pixels in 16-bit words, so at bpp bits per pixel
+    the x coordinate and width of an area must be a multiple of this.
+    '''
+    return 16 // bpp
+
+def is_aligned(xy, dims, bpp):
+    align = pixel_alignment(bpp)
+    return xy[0] % align == 0 and dims[0] % align == 0
+
+def packed_size(dims, bpp):
+    return dims[0]*dims[1]*bpp//8
+
+def _reverse_lut(bpp):
+    '''
+    A table that reverses the order of the pixels packed into each byte.
+    '''
+    per_byte = 8 // bpp
+    mask = (1 << bpp) - 1
+    lut = np.zeros(256, dtype=np.uint8)
+    for value in range(256):
+        for i in range(per_byte):
+            pixel = (value >> (i*bpp)) & mask
+            lut[value] |= pixel << ((per_byte-1-i)*bpp)
+    return lut
+
+REVERSE_LUTS = {bpp: _reverse_lut(bpp) for bpp in (1, 2, 4)}
+
+def pack(pixels, bpp):
+    '''
+    Pack a 2D array of 8-bit pixels into bpp bits per pixel, keeping the most
+    significant bits of each. The width must be a multiple of 8//bpp.
+    '''
+    pixels = np.asarray(pixels, dtype=np.uint8)
+    if bpp == 8:
+        return pixels.ravel()
+
+    per_byte = 8 // bpp
+    height, width = pixels.shape
+    if width % per_byte:
+        raise ValueError('width {} cannot be packed at {} bpp'.format(width, bpp))
+
+    values = (pixels >> (8-bpp)).reshape(height, width//per_byte, per_byte)
+    shifts = (np.arange(per_byte)*bpp).astype(np.uint8)
+    return np.bitwise_or.reduce(values << shifts, axis=-1).ravel()
+
+def unpack(packed, bpp, width):
+    '''
+    The inverse of pack: expand packed pixels back to 8 bits per pixel, as a 2D
+    array with the given width. Each value is scaled to fill the whole range
+    (e.g. 1bpp unpacks to 0x00 and 0xFF).
+    '''
+    packed = np.frombuffer(packed, dtype=np.uint8) if not isinstance(packed, np.ndarray) else packed
+    if bpp == 8:
+        return packed.reshape(-1, width)
+
+    per_byte = 8 // bpp
+    shifts = (np.arange(per_byte)*bpp).astype(np.uint8)
+    values = (packed[:, np.newaxis] >> shifts) & ((1 << bpp) - 1)
+    scale = 0xFF // ((1 << bpp) - 1)
+    return (values*scale).astype(np.uint8).reshape(-1, width)
+
+def flip_packed(packed, bpp):
+    '''
+    Rotate a packed area by 180 degrees, without unpacking it. Reversing the bytes
+    reverses the rows and the order of the bytes within them, and the lookup table
+    reverses the pixels within each byte.
+    '''
+    packed = np.frombuffer(packed, dtype=np.uint8) if not isinstance(packed, np.ndarray) else packed
+    if bpp == 8:
+        return packed[::-1]
+    return REVERSE_LUTS[bpp][packed[::-1]]
+
+def load_packed(epd, data, xy, dims, bpp):
+    '''
+    Load an area of pixels that are already packed at bpp bits per pixel into the
+    controller's image buffer.
+    '''
+    if bpp == 8:
+        epd.load_img_area(data, xy=xy, dims=dims)
+        return
+
+    if bpp == 1:
+        # there's no 1bpp load format; in 1bpp mode the controller reads
+        # 8 pixels from each byte of an 8bpp load
+        pixel_format = PixelModes.M_8BPP
+        xy = (xy[0]//8, xy[1])
+        dims = (dims[0]//8, dims[1])
+    else:
+        pixel_format = {2: PixelModes.M_2BPP, 4: PixelModes.M_4BPP}[bpp]
+
+    # the driver's load_img_area expects 8bpp input, so use its lower-level
+    # image load to send our bytes as they are
+    epd._set_img_buf_base_addr(epd.img_buf_address)
+    epd._load_img_area_start(EndianTypes.LITTLE, pixel_format, Rotate.NONE, xy, dims)
+    epd.spi.write_pixels(data)
+    epd._load_img_end()
+
+def display_packed(epd, xy, dims, mode, bpp):
+    '''
+    Display an area that was loaded with load_packed.
+    '''
+    if bpp != 1:
+        epd.display_area(xy, dims, mode)
+        return
+
+    # 1bpp mode draws set bits in the foreground value and clear bits in the background one
+    epd.write_register(UP1SR+2, epd.read_register(UP1SR+2) | (1 << 2))
+    epd.write_register(BGVR, (0xFF << 8) | 0x00)
+
+    epd.display_area(xy, dims, mode)
+
+    # the controller reads the flag while it runs the waveform, so we need to wait to clear it
+    epd.wait_display_ready()
+    epd.write_register(UP1SR+2, epd.read_register(UP1SR+2) & ~(1 << 2))
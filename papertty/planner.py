@@ -0,0 +1,233 @@
+'''
+This file decides how the regions of the screen that changed in a frame
+get sent to the e-paper display.
+
+Every refresh of the panel has a fixed cost (sending the command, and
+running the waveform, which takes the same time no matter how big the area
+is), plus a cost that grows with the area (the pixels have to be sent over
+SPI). So it is worth merging two nearby regions into one refresh, but not
+if that means refreshing a large empty area in between them. The
+RefreshPlanner uses a CostModel to make that decision.
+'''
+
+import numpy as np
+from IT8951.constants import DisplayModes
+
+# how "thorough" each waveform is. when two regions are merged, the merged region
+# needs the most thorough of their waveforms
+MODE_RANK = {
+    DisplayModes.A2: 0,
+    DisplayModes.DU: 1,
+    DisplayModes.DU4: 2,
+    DisplayModes.GL16: 3,
+    DisplayModes.GLR16: 3,
+    DisplayModes.GLD16: 3,
+    DisplayModes.GC16: 4,
+    DisplayModes.INIT: 5,
+}
+
+def stronger_mode(a, b):
+    '''
+    Whichever of waveform modes a and b can display everything the other one can.
+    '''
+    return a if MODE_RANK[a] >= MODE_RANK[b] else b
+
+def box_union(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def box_area(box):
+    return (box[2]-box[0])*(box[3]-box[1])
+
+def boxes_overlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+def box_intersection(a, b):
+    '''
+    The area that boxes a and b have in common, or None if they don't overlap.
+    '''
+    if not boxes_overlap(a, b):
+        return None
+    return (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+
+def subtract_boxes(box, others):
+    '''
+    The parts of box that aren't covered by any of the boxes in others, as a list
+    of non-overlapping boxes.
+    '''
+    remaining = [box]
+    for other in others:
+        pieces = []
+        for piece in remaining:
+            if not boxes_overlap(piece, other):
+                pieces.append(piece)
+                continue
+
+            # the bands above and below other, and the parts to its left and right
+            x0, y0, x1, y1 = piece
+            top, bottom = max(y0, other[1]), min(y1, other[3])
+            for part in ((x0, y0, x1, top), (x0, bottom, x1, y1),
+                         (x0, top, max(x0, other[0]), bottom), (min(x1, other[2]), top, x1, bottom)):
+                if part[0] < part[2] and part[1] < part[3]:
+                    pieces.append(part)
+        remaining = pieces
+    return remaining
+
+class CostModel:
+    '''
+    Estimates the time (in seconds) that the panel takes to refresh an area
+    with a given waveform mode. The defaults are rough numbers for the IT8951
+    panels with SPI at 24 MHz; they can be tuned for a particular panel by
+    passing any of the parameters.
+
+    Parameters
+    ----------
+
+    overhead : float
+        Fixed time for each update (sending the commands, waiting on the controller)
+
+    waveform_times : dict
+        The time it takes to run each waveform, keyed by DisplayModes
+
+    spi_hz : float
+        The SPI clock rate used to send pixels to the controller
+
+    bits_per_pixel : dict
+        How many bits per pixel get sent for each mode (default 8)
+    '''
+
+    def __init__(self, overhead=0.01, waveform_times=None, spi_hz=24000000, bits_per_pixel=None):
+        self.overhead = overhead
+        self.spi_hz = spi_hz
+
+        self.waveform_times = {
+            DisplayModes.INIT: 2.0,
+            DisplayModes.A2: 0.12,
+            DisplayModes.DU: 0.26,
+            DisplayModes.DU4: 0.29,
+            DisplayModes.GL16: 0.45,
+            DisplayModes.GLR16: 0.45,
+            DisplayModes.GLD16: 0.45,
+            DisplayModes.GC16: 0.75,
+        }
+        if waveform_times is not None:
+            self.waveform_times.update(waveform_times)
+
+        self.bits_per_pixel = {}
+        if bits_per_pixel is not None:
+            self.bits_per_pixel.update(bits_per_pixel)
+
+    def cost(self, box, mode):
+        '''
+        The estimated time to refresh the area box (x0, y0, x1, y1) with the given mode.
+        '''
+        bits = self.bits_per_pixel.get(mode, 8)
+        return self.overhead + self.waveform_times[mode] + box_area(box)*bits/self.spi_hz
+
+class RefreshPlanner:
+    '''
+    Merges the dirty rectangles of a frame into the set of display updates
+    that the cost model thinks will take the least total time.
+
+    Splitting falls out of where the rectangles come from: the terminal reports
+    one rectangle per run of changed characters, so a refresh never covers more
+    than the runs that were merged into it.
+
+    Parameters
+    ----------
+
+    cost_model : CostModel
+        The cost model to use (default: CostModel())
+
+    align : int
+        The horizontal edges of each update are rounded out to a multiple of this,
+        as the controller requires
+
+    dims : (int, int)
+        The size of the display, which updates are clipped to
+    '''
+
+    def __init__(self, dims, cost_model=None, align=4):
+        self.dims = dims
+        self.cost_model = CostModel() if cost_model is None else cost_model
+        self.align = align
+
+    def plan(self, rects):
+        '''
+        Parameters
+        ----------
+
+        rects : list of ((x0, y0, x1, y1), mode)
+            The regions that changed, and the waveform mode each one needs
+
+        Returns
+        -------
+
+        list of ((x0, y0, x1, y1), mode)
+            The updates to send to the display, in top-to-bottom order
+        '''
+        items = [(self._align(box), mode) for box, mode in rects if box_area(box) > 0]
+        if not items:
+            return []
+
+        # sorting by the top edge makes regions that are close on the screen close in the list.
+        # then we repeatedly merge whichever neighboring pair saves the most time, until
+        # no merge saves anything
+        items.sort(key=lambda item: (item[0][1], item[0][0]))
+        costs = [self.cost_model.cost(box, mode) for box, mode in items]
+        savings = np.array([self._saving(items, costs, i) for i in range(len(items)-1)], dtype=float)
+
+        while savings.size:
+            i = int(np.argmax(savings))
+            if savings[i] <= 0:
+                break
+
+            items[i] = self._merge(items[i], items[i+1])
+            costs[i] = self.cost_model.cost(*items[i])
+            del items[i+1], costs[i+1]
+            savings = np.delete(savings, i)
+
+            # only the savings involving the merged item have changed
+            if i > 0:
+                savings[i-1] = self._saving(items, costs, i-1)
+            if i < savings.size:
+                savings[i] = self._saving(items, costs, i)
+
+        return self._merge_overlapping(items)
+
+    def _saving(self, items, costs, i):
+        '''
+        How much time merging items i and i+1 would save
+        '''
+        merged = self._merge(items[i], items[i+1])
+        return costs[i] + costs[i+1] - self.cost_model.cost(*merged)
+
+    def _merge_overlapping(self, items):
+        '''
+        The greedy merge only considers neighbors; anything left that overlaps would
+        refresh the same pixels twice, so merge it no matter what.
+        '''
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(items)):
+                for j in range(i+1, len(items)):
+                    if boxes_overlap(items[i][0], items[j][0]):
+                        items[i] = self._merge(items[i], items[j])
+                        del items[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+
+        items.sort(key=lambda item: (item[0][1], item[0][0]))
+        return items
+
+    @staticmethod
+    def _merge(a, b):
+        return box_union(a[0], b[0]), stronger_mode(a[1], b[1])
+
+    def _align(self, box):
+        x0, y0, x1, y1 = box
+        x0 -= x0 % self.align
+        x1 += -x1 % self.align
+        return (max(x0, 0), max(y0, 0), min(x1, self.dims[0]), min(y1, self.dims[1]))
@@ -1,7 +1,18 @@
 
 import numpy as np
+from time import perf_counter
 from PIL import Image, ImageFont, ImageDraw
-from .vcsa import TTY_DTYPE
+from .glyphs import GlyphAtlas
+from .metrics import Metrics
+from .planner import boxes_overlap
+
+# fonts to look for characters in, if the terminal's font doesn't have them
+FALLBACK_FONT_PATHS = [
+    '/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/truetype/noto/NotoSansMono-Regular.ttf',
+    '/usr/share/fonts/truetype/unifont/unifont.ttf',
+]
 
 # mapping 3-bit colors (from VGA mode text) to
 # e-paper display colors
@@ -16,12 +27,123 @@ for x in range(1, 7):
     BG_COLOR_MAP.append(0xB0^(x<<3)&0xF0)
 BG_COLOR_MAP.append(0x00)  # white should map to real black
 
+# the same mappings as lookup tables indexed by the whole attribute byte,
+# so that we can decode an entire screen at once
+_ATTRS = np.arange(256)
+FG_LUT = np.array(FG_COLOR_MAP, dtype=np.uint8)[_ATTRS & 0x07]
+BG_LUT = np.array(BG_COLOR_MAP, dtype=np.uint8)[(_ATTRS & 0b01110000) >> 4]
+BOLD_LUT = (_ATTRS & 0x08).astype(bool)
+
+# whether a cell with a given attribute contains any gray (not b&w)
+GRAY_LUT = ((FG_LUT != 0x00) & (FG_LUT != 0xFF)) | ((BG_LUT != 0x00) & (BG_LUT != 0xFF))
+
+def decode_attrs(data):
+    '''
+    Decode the attributes of a whole array of terminal data (as returned by
+    vcsa.read_vcsa) into foreground color, background color, and bold planes.
+    '''
+    attrs = data['attr']
+    return FG_LUT[attrs], BG_LUT[attrs], BOLD_LUT[attrs]
+
+def cell_codepoints(chars, fg, bg):
+    '''
+    The codepoints to draw cells with. Cells that are only background get drawn
+    as a space, so they don't need their own cache entries.
+    '''
+    return np.where((chars == 0x20) | (chars == 0x00) | (fg == bg), 0x20, chars)
+
+def shared_frame(pixels):
+    '''
+    Wrap a 2D uint8 numpy array in an 'L' mode PIL image that shares its memory,
+    so that drawing with PIL and assigning to slices of the array modify the
+    same frame buffer.
+    '''
+    height, width = pixels.shape
+    img = Image.frombuffer('L', (width, height), pixels, 'raw', 'L', 0, 1)
+
+    # frombuffer marks the image read-only, which would make PIL copy it
+    # the first time we draw on it. we really do want to write through it.
+    img.readonly = 0
+
+    return img
+
+def _row_hashes(data):
+    '''
+    A 64-bit hash of each row of a 2D array, computed from its raw bytes.
+    '''
+    raw = np.ascontiguousarray(data).view(np.uint8).reshape(data.shape[0], -1)
+
+    # a polynomial hash. the uint64 arithmetic is allowed to wrap around
+    weights = np.cumprod(np.full(raw.shape[1], 0x100000001B3, dtype=np.uint64))
+    return (raw.astype(np.uint64)*weights).sum(axis=1, dtype=np.uint64)
+
+def find_scroll(old, new, min_rows=2):
+    '''
+    Look for a band of rows that moved vertically between two frames of terminal
+    data, as when output scrolls the whole screen or a scroll region (like the
+    text area of less or vim).
+
+    Parameters
+    ----------
+
+    old, new : np.ndarray
+        The previous and current terminal data, of the same shape
+
+    min_rows : int
+        The smallest band worth reporting
+
+    Returns
+    -------
+
+    (int, int, int) or None
+        (top, bottom, offset), meaning that rows top to bottom-1 of new are
+        exactly rows top+offset to bottom+offset-1 of old. None if nothing scrolled.
+    '''
+    if old.shape != new.shape:
+        return None
+
+    rows = old.shape[0]
+    old_hashes = _row_hashes(old)
+    new_hashes = _row_hashes(new)
+
+    # rows that show up more than once (blank lines, mostly) would vote for
+    # every offset, so only rows that are unique in the old frame get a vote
+    unique = np.count_nonzero(old_hashes[:, np.newaxis] == old_hashes[np.newaxis, :], axis=1) == 1
+    new_ys, old_ys = np.nonzero((new_hashes[:, np.newaxis] == old_hashes[np.newaxis, :]) & unique)
+    offsets = old_ys - new_ys
+    offsets = offsets[offsets != 0]
+    if offsets.size < min_rows:
+        return None
+
+    votes = np.bincount(offsets + rows)
+    offset = int(np.argmax(votes)) - rows
+    if votes[offset + rows] < min_rows:
+        return None
+
+    # hashes can collide, so check the rows themselves, and take the longest
+    # run of rows that really did move by this offset
+    lo, hi = max(0, -offset), min(rows, rows - offset)
+    moved = np.all(new[lo:hi] == old[lo+offset:hi+offset], axis=1)
+    edges = np.diff(np.concatenate(([0], moved.astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    if not starts.size:
+        return None
+
+    longest = int(np.argmax(ends - starts))
+    top, bottom = lo + int(starts[longest]), lo + int(ends[longest])
+    if bottom - top < min_rows:
+        return None
+
+    return top, bottom, offset
+
 class Terminal:
     '''
     A class that renders an image of the given terminal data.
     '''
 
-    def __init__(self, display_dims, frame_buf=None, font=None, bold_font=None, line_spacing=1):
+    def __init__(self, display_dims, frame_buf=None, font=None, bold_font=None, line_spacing=1,
+                 glyph_cache_size=16384, warm_glyphs=True, detect_scroll=True, fallback_fonts=None,
+                 mono=False, metrics=None):
 
         self.cursor_pos = None
 
@@ -36,15 +158,41 @@ class Terminal:
         self.line_spacing = line_spacing
         self.char_dims = self.get_char_dims(self.line_spacing)
 
+        # pre-rendered character cells, so we don't rasterize the same glyph over and over.
+        # in mono mode, black and white text isn't antialiased, so it stays black and white.
+        # unless we're given fallback fonts, the atlas loads them when it first needs them
+        self.glyphs = GlyphAtlas(self.font, self.bold_font, self.char_dims, max_size=glyph_cache_size,
+                                 fallback_fonts=fallback_fonts or (),
+                                 fallback_font_paths=FALLBACK_FONT_PATHS if fallback_fonts is None else (),
+                                 mono=mono)
+        if warm_glyphs:
+            self.glyphs.warm(FG_COLOR_MAP, BG_COLOR_MAP)
+
         # use 8 bits per pixel for display that can handle grayscale
         # may want to change this later and use bitmap font
         # 0xFF = white
+        # the image is backed by a numpy array so that we can do fills with slice assignment.
+        # if frame_buf is given its contents are copied, and the caller should use
+        # self.display as the frame buffer from then on.
         if frame_buf is None:
-            self.display = Image.new('L', display_dims, 0xFF)
+            self.pixels = np.full(display_dims[::-1], 0xFF, dtype=np.uint8)
         else:
-            self.display = frame_buf
+            self.pixels = np.array(frame_buf, dtype=np.uint8)
+        self.display = shared_frame(self.pixels)
 
         self.data = None
+        self.dirty = []
+
+        # when the text scrolls, we move the pixels instead of drawing everything again
+        self.detect_scroll = detect_scroll
+        self.scrolls = 0
+        self.scroll_cells_saved = 0
+        self.last_scroll = None
+
+        if metrics is None:
+            metrics = Metrics()
+        self.diff_time = metrics.histogram('diff_seconds', 'Time spent finding the characters that changed')
+        self.render_time = metrics.histogram('render_seconds', 'Time spent drawing the characters that changed')
 
     def _draw_cursor(self, position, tty_data, draw, remove=False):
         cursor_x = position[0]*self.char_dims[0]
@@ -63,10 +211,27 @@ class Terminal:
         # whether we drew any gray
         return bg_color not in (0x00, 0xFF)
 
-    def update(self, cursor_pos, data, callback=lambda *args, **kwargs: None):
+    def restore(self, cursor_pos, data, pixels):
+        '''
+        Start from an image of the given terminal data (as saved from an earlier
+        Terminal with the same font and size), instead of a blank screen, so that
+        the next update only draws what differs from it.
+        '''
+        self.pixels[:] = pixels
+        self.data = data.copy()
+        self.cursor_pos = cursor_pos
+
+    def update(self, cursor_pos, data):
         '''
         Update the image of our terminal.
 
+        After this returns, self.dirty holds the regions of the image that changed,
+        as a list of ((x0, y0, x1, y1), gray) tuples in pixel coordinates, where
+        gray says whether the region contains any gray (so can't be displayed
+        with a black-and-white waveform). There is one region for each run of
+        changed characters in a row, plus the old and new cursor positions, plus
+        the band of rows that was moved if the text scrolled.
+
         Parameters
         ----------
 
@@ -76,9 +241,6 @@ class Terminal:
         data : np.ndarray
             A numpy array as returned by vcsa.get_vcsa
 
-        callback : function
-            A function that will be called for intermediate updates
-
         Returns
         -------
 
@@ -86,86 +248,236 @@ class Terminal:
             The number of characters changed
 '''
 
+        self.dirty = []
+        start = perf_counter()
+
+        if self.data is not None and (self.data.shape, self.data.dtype) != (data.shape, data.dtype):
+            # the console was resized (or we're reading it differently), so start over from a blank screen
+            self.pixels[:] = 0xFF
+            self.dirty.append(((0, 0) + self.display.size, False))
+            self.cursor_pos = None
+            self.data = None
+
         if self.data is None:
             # this is the data that would yield an all-white screen, so since
             # we've set our display to all white we'll use that as the starting point
-            self.data = np.full(data.shape, np.array((0x20, 0x07), dtype=data.dtype), dtype=TTY_DTYPE)
+            self.data = np.full(data.shape, np.array((0x20, 0x07), dtype=data.dtype), dtype=data.dtype)
 
         # if nothing has changed, we don't need to do anything
         if cursor_pos == self.cursor_pos and np.array_equal(self.data, data):
+            self.diff_time.observe(perf_counter() - start)
             return 0
 
         draw = ImageDraw.Draw(self.display)
 
+        # remove old cursor. it's drawn over the cells below its line, so draw those again
+        # (or, below the last line, draw over it in the background color). that also has to
+        # happen before the pixels get moved, if the text scrolled, or it moves with them
+        if self.cursor_pos is not None:
+            if self._restore_cursor_cells(self.cursor_pos):
+                old_gray = self.gray(self._cursor_box(self.cursor_pos))
+            else:
+                old_gray = self._draw_cursor(self.cursor_pos, data, draw, remove=True)
+            self.dirty.append((self._cursor_box(self.cursor_pos), old_gray))
+
+        # if the text scrolled, move the pixels along with it. after that, what's on
+        # the screen corresponds to the old data with the same rows moved
+        # (only among the rows that fit on the display completely, so that the pixels
+        # we move are all there)
+        old_data = self.data
+        full_rows = self.pixels.shape[0] // self.char_dims[1]
+        self.last_scroll = find_scroll(old_data[:full_rows], data[:full_rows]) if self.detect_scroll else None
+        if self.last_scroll is not None:
+            old_data = self._scroll(self.last_scroll, data)
+
         # all of the places where the character or attribute has changed
-        diffs = np.nonzero(data != self.data)
+        diffs = np.nonzero(data != old_data)
+        ys, xs = diffs
 
-        # set to true when we make a change that requires a grayscale update (not b&w)
-        gray_changes = True
+        # a console bigger than the display only shows as much of it as fits
+        rows, cols = self._visible_cells()
+        if rows < data.shape[0] or cols < data.shape[1]:
+            visible = (ys < rows) & (xs < cols)
+            diffs = ys, xs = ys[visible], xs[visible]
 
-        # remove old cursor
-        if self.cursor_pos is not None:
-            gray_changes = self._draw_cursor(self.cursor_pos, data, draw, remove=True) or gray_changes
-            # only call callback if we won't already be updating this spot below
-            # (e.g. old cursor was on a different line than all text changes)
-            if diffs[0].size and self.cursor_pos[1] != diffs[0][0]:
-                callback(gray_changes)
-                gray_changes = True
-
-        # iterate through the places where the data arrays differ, changing the character there
-        prev_y = diffs[0][0] if diffs[0].size else None
-        for y,x in zip(*diffs):
-
-            # call callback if there was a gap between the rows
-            # main idea is to avoid updating half the screen because the text in two distant
-            # areas changed.
-            if y > prev_y + 5:
-                callback(gray_changes)
-                gray_changes = True
-
-            prev_y = y
-
-            pos = (x*self.char_dims[0], y*self.char_dims[1])
-            old_attr = self.data[y,x]['attr']
-            new_attr = data[y,x]['attr']
-
-            # need to write background color box to remove any character that is already there
-            # or if background color has changed
-            bg_color = BG_COLOR_MAP[(new_attr&0b01110000) >> 4]
-            if (old_attr ^ new_attr) & 0b01110000 or chr(self.data[y,x]['char']) != ' ':
-                box = pos[0], pos[1], pos[0]+self.char_dims[0], pos[1]+self.char_dims[1]
-                draw.rectangle(box, fill=bg_color)
-
-            # whether to use "high-intensity" (bold)
-            font = self.bold_font if new_attr & 0x08 else self.font
-
-            # foreground color
-            fg_color = FG_COLOR_MAP[new_attr & 0x07]
-
-            # we are basically ignoring the encoding, by hoping it's ASCII (calling chr())
-            # we expect to usually be UTF-8, which is ASCII most of the time
-            # I'm not sure how /dev/vcsa handles encoding+attributes anyway
-            draw.text(pos, chr(data[y,x]['char']), font=font, fill=fg_color)
-
-            # whether we have drawn any gray
-            gray_changes = gray_changes or bg_color not in (0x00, 0xFF)
-            gray_changes = gray_changes or fg_color not in (0x00, 0xFF)
-
-        # if the last text that happened was not on the same row as the cursor we're about to update, then
-        # run the callback
-        if prev_y != cursor_pos[1]:
-            callback(gray_changes)
-            gray_changes = True
+        # decode the whole screen at once, rather than twiddling bits for each cell
+        fg, bg, bold = decode_attrs(data)
+        gray = GRAY_LUT[data['attr']]
 
-        # place cursor
-        gray_changes = self._draw_cursor(cursor_pos, data, draw) or gray_changes
+        # data read from /dev/vcsu has real unicode codepoints. from /dev/vcsa we only get the console
+        # font's 8-bit index, so we are basically hoping it's ASCII (the codepoint gets chr()'d)
+        codepoints = cell_codepoints(data['char'], fg, bg)
+
+        diffed = perf_counter()
+        self.diff_time.observe(diffed - start)
 
-        callback(gray_changes)
+        # draw each run of changed cells in one go, by joining the cached cells
+        # (which include their backgrounds) straight into the frame buffer
+        width, height = self.char_dims
+        for y, x0, x1 in self._runs(diffs):
+            self._paste_run(y, x0, x1, [
+                self.glyphs.get(int(codepoints[y,x]), bool(bold[y,x]), int(fg[y,x]), int(bg[y,x]))
+                for x in range(x0, x1)
+            ])
+
+        self.dirty.extend(self._changed_runs(diffs, gray))
+
+        # place cursor
+        new_gray = self._draw_cursor(cursor_pos, data, draw)
+        self.dirty.append((self._cursor_box(cursor_pos), new_gray))
 
         self.cursor_pos = cursor_pos
         self.data = data
 
-        return diffs[0].size + 1 # +1 for cursor movement
+        self.render_time.observe(perf_counter() - diffed)
+
+        return ys.size + 1 # +1 for cursor movement
+
+    def _paste_run(self, y, x0, x1, tiles):
+        '''
+        Put the tiles of cells x0 to x1-1 of row y into the frame buffer.
+        '''
+        width, height = self.char_dims
+        out = self.pixels[y*height:(y+1)*height, x0*width:x1*width]
+        if out.shape == (height, (x1-x0)*width):
+            np.concatenate(tiles, axis=1, out=out)
+        else:
+            # the run goes off the edge of the display
+            out[:] = np.concatenate(tiles, axis=1)[:out.shape[0], :out.shape[1]]
+
+    def _restore_cursor_cells(self, position):
+        '''
+        Draw the cells that the cursor at position was drawn over (the first row
+        of pixels of the line below it, and a pixel into the next cell) again, as
+        self.data has them. Returns False if the cursor is below the last line, or
+        off the display, so there aren't any.
+        '''
+        x, y = position[0], position[1] + 1
+        rows, cols = self._visible_cells()
+        if y >= min(rows, self.data.shape[0]) or x >= min(cols, self.data.shape[1]):
+            return False
+
+        cells = self.data[y, x:x+2]
+        fg, bg, bold = decode_attrs(cells)
+        codepoints = cell_codepoints(cells['char'], fg, bg)
+        self._paste_run(y, x, x+cells.size, [
+            self.glyphs.get(int(codepoint), bool(b), int(f), int(g))
+            for codepoint, b, f, g in zip(codepoints, bold, fg, bg)
+        ])
+        return True
+
+    def _scroll(self, scroll, data):
+        '''
+        Move the pixels of a band of rows that scrolled (as found by find_scroll),
+        and add the band to the dirty regions. Returns a copy of self.data with
+        the same rows moved, to diff the new data against.
+        '''
+        top, bottom, offset = scroll
+        height = self.char_dims[1]
+
+        # numpy handles the overlap between source and destination for us
+        self.pixels[top*height:bottom*height] = self.pixels[(top+offset)*height:(bottom+offset)*height]
+
+        moved = self.data.copy()
+        moved[top:bottom] = self.data[top+offset:bottom+offset]
+
+        # the rows in the band that would otherwise have been drawn one character at a time
+        changed = data[top:bottom] != self.data[top:bottom]
+        self.scrolls += 1
+        self.scroll_cells_saved += int(np.count_nonzero(changed))
+
+        # only the rows that actually look different need a refresh
+        changed_rows = np.flatnonzero(np.any(changed, axis=1))
+        if changed_rows.size:
+            band_gray = bool(np.any(GRAY_LUT[data['attr'][top:bottom]]))
+            box = (0, (top+int(changed_rows[0]))*height, self.display.size[0], (top+int(changed_rows[-1])+1)*height)
+            self.dirty.append((box, band_gray))
+
+        return moved
+
+    @staticmethod
+    def _run_bounds(diffs):
+        '''
+        Split the (row-major) coordinates of changed cells into horizontal runs of
+        contiguous cells, as arrays of the first and last index of each run.
+        '''
+        ys, xs = diffs
+
+        # a new run starts wherever the row changes or the columns aren't contiguous
+        starts = np.concatenate(([0], np.flatnonzero((np.diff(ys) != 0) | (np.diff(xs) != 1)) + 1))
+        ends = np.append(starts[1:], ys.size) - 1
+        return starts, ends
+
+    def _runs(self, diffs):
+        '''
+        The horizontal runs of changed cells, as (row, first column, last column + 1).
+        '''
+        ys, xs = diffs
+        if not ys.size:
+            return []
+
+        starts, ends = self._run_bounds(diffs)
+        return [(int(ys[s]), int(xs[s]), int(xs[e])+1) for s, e in zip(starts, ends)]
+
+    def _changed_runs(self, diffs, gray):
+        '''
+        Turn the (row-major) coordinates of changed cells into one pixel rectangle
+        for each horizontal run of contiguous changed cells.
+        '''
+        ys, xs = diffs
+        if not ys.size:
+            return []
+
+        starts, ends = self._run_bounds(diffs)
+        run_gray = np.logical_or.reduceat(gray[diffs], starts)
+
+        width, height = self.char_dims
+        max_x, max_y = self.display.size
+        return [
+            ((int(xs[s])*width, int(ys[s])*height,
+              min((int(xs[e])+1)*width, max_x), min((int(ys[s])+1)*height, max_y)), bool(g))
+            for s, e, g in zip(starts, ends, run_gray)
+        ]
+
+    def _visible_cells(self):
+        '''
+        How many rows and columns of characters are at least partly on the display.
+        '''
+        width, height = self.char_dims
+        return -(-self.pixels.shape[0] // height), -(-self.pixels.shape[1] // width)
+
+    def gray(self, box):
+        '''
+        Whether any of the characters at least partly in the pixel rectangle box
+        (x0, y0, x1, y1), or the cursor if it's there, are drawn with gray, as
+        for the regions in self.dirty.
+        '''
+        if self.data is None:
+            return False
+
+        width, height = self.char_dims
+        attrs = self.data['attr'][box[1]//height:-(-box[3]//height), box[0]//width:-(-box[2]//width)]
+        if np.any(GRAY_LUT[attrs]):
+            return True
+
+        if self.cursor_pos is None:
+            return False
+        return boxes_overlap(box, self._cursor_box(self.cursor_pos)) and \
+            bool(GRAY_LUT[self.data['attr'][self.cursor_pos[1], self.cursor_pos[0]]])
+
+    def _cursor_box(self, position):
+        '''
+        The pixel rectangle covered by the cursor drawn at the given text coordinates.
+        '''
+        cursor_x = position[0]*self.char_dims[0]
+        cursor_y = (position[1]+1)*self.char_dims[1]
+        width, height = self.display.size
+        return (
+            min(cursor_x, width),
+            min(cursor_y, height),
+            min(cursor_x+self.char_dims[0]+1, width),
+            min(cursor_y+1, height),
+        )
 
     def get_char_dims(self, line_spacing):
         '''
@@ -0,0 +1,256 @@
+'''
+This file simulates an IT8951 e-paper display, so that PaperTTY (and the
+Controller) can run end to end without the panel: on a computer without SPI,
+or to measure changes to the pipeline.
+
+SimulatedEPD has the parts of IT8951.interface.EPD that we use. It takes its
+timings from the same CostModel that the RefreshPlanner uses: sending pixels
+takes as long as their bits take over SPI, and each refresh keeps the panel
+busy for its waveform's duration (which doesn't depend on the area). Like the
+real controller, display_area() returns right away, and wait_display_ready()
+waits for the refresh to finish.
+
+It keeps the controller's image buffer and what the panel shows. Ghosting is
+modeled roughly: the fast waveforms leave a little of the old pixel behind each
+time they change one, which builds up until a GC16 (or INIT) refresh clears it,
+and the other grayscale waveforms clear some of it. What the panel shows can be
+saved as a PNG after every refresh.
+'''
+
+import os
+from time import perf_counter, sleep
+
+import numpy as np
+from PIL import Image
+from IT8951.constants import DisplayModes, PixelModes
+
+from .planner import CostModel
+from .pixels import unpack, UP1SR, BGVR
+
+# how much of the old pixel is left behind when a waveform changes a pixel
+GHOSTING = {
+    DisplayModes.A2: 0.12,
+    DisplayModes.DU: 0.06,
+    DisplayModes.DU4: 0.05,
+}
+
+# and how much of the ghosting a waveform clears from the pixels it refreshes
+CLEARING = {
+    DisplayModes.GL16: 0.5,
+    DisplayModes.GLR16: 0.5,
+    DisplayModes.GLD16: 0.5,
+    DisplayModes.GC16: 1,
+    DisplayModes.INIT: 1,
+}
+
+# the gray levels that each waveform can drive a pixel to
+LEVELS = {
+    DisplayModes.A2: 2,
+    DisplayModes.DU: 2,
+    DisplayModes.DU4: 4,
+}
+
+BITS_FOR_FORMAT = {
+    PixelModes.M_2BPP: 2,
+    PixelModes.M_4BPP: 4,
+    PixelModes.M_8BPP: 8,
+}
+
+class SimulatedSPI:
+    '''
+    Receives the pixels of an image load started with _load_img_area_start().
+    '''
+
+    def __init__(self, epd):
+        self.epd = epd
+
+    def write_pixels(self, pixels):
+        self.epd._write_pixels(pixels)
+
+class SimulatedEPD:
+    '''
+    Stands in for IT8951.interface.EPD.
+
+    Parameters
+    ----------
+
+    width, height : int
+        The size of the panel (default: the 10.3" panel's 1872x1404)
+
+    cost_model : planner.CostModel
+        How long sending pixels and each waveform take (default: CostModel())
+
+    realtime : bool
+        Whether to actually take that long. Otherwise the time is only added up,
+        and everything runs as fast as it can
+
+    frames_dir : str, optional
+        Save what the panel shows here after each refresh, as numbered PNGs
+    '''
+
+    def __init__(self, width=1872, height=1404, cost_model=None, realtime=True, frames_dir=None):
+        self.width = width
+        self.height = height
+        self.cost_model = CostModel() if cost_model is None else cost_model
+        self.realtime = realtime
+
+        self.frames_dir = frames_dir
+        if frames_dir is not None:
+            os.makedirs(frames_dir, exist_ok=True)
+
+        self.img_buf_address = 0
+        self.spi = SimulatedSPI(self)
+        self.registers = {}
+
+        # the controller's image buffer, and the panel: the gray level each pixel is being
+        # driven to, and how far off from that the ghosting leaves it
+        self.buffer = np.full((height, width), 0xFF, dtype=np.uint8)
+        self.panel = np.full((height, width), 0xFF, dtype=np.uint8)
+        self.ghosting = np.zeros((height, width), dtype=np.float32)
+
+        self.loading = None  # (pixel format, xy, dims) of the image load in progress
+
+        # when the current refresh finishes, on our clock
+        self.clock = 0
+        self.busy_until = 0
+
+        self.refreshes = {}
+        self.bytes_sent = 0
+        self.spi_seconds = 0
+        self.busy_seconds = 0
+        self.wait_seconds = 0
+        self.frames_saved = 0
+
+    def now(self):
+        return perf_counter() if self.realtime else self.clock
+
+    def _take(self, seconds):
+        '''
+        Spend seconds doing something that keeps the host busy.
+        '''
+        if self.realtime:
+            sleep(seconds)
+        else:
+            self.clock += seconds
+
+    def wait_display_ready(self):
+        remaining = self.busy_until - self.now()
+        if remaining > 0:
+            self.wait_seconds += remaining
+            self._take(remaining)
+
+    def load_img_area(self, buf, rotate_mode=None, xy=None, dims=None, pixel_format=None):
+        if xy is None:
+            xy = (0, 0)
+        if dims is None:
+            dims = (self.width, self.height)
+
+        # the driver converts the 8bpp pixels it's given to pixel_format before sending them
+        bpp = BITS_FOR_FORMAT.get(pixel_format, 8)
+        self._send(dims[0]*dims[1]*bpp//8)
+
+        pixels = np.frombuffer(bytes(buf), dtype=np.uint8).reshape(dims[1], dims[0])
+        self.buffer[xy[1]:xy[1]+dims[1], xy[0]:xy[0]+dims[0]] = pixels >> (8-bpp) << (8-bpp)
+
+    def _set_img_buf_base_addr(self, address):
+        pass
+
+    def _load_img_area_start(self, endian_type, pixel_format, rotate_mode, xy, dims):
+        self.loading = (pixel_format, xy, dims)
+
+    def _write_pixels(self, pixels):
+        '''
+        Take the pixels of the image load in progress into the image buffer. Loads
+        are little-endian and unrotated, as load_packed() sends them.
+        '''
+        data = np.frombuffer(bytes(pixels), dtype=np.uint8)
+        self._send(data.size)
+
+        pixel_format, (x, y), (w, h) = self.loading
+        self.buffer[y:y+h, x:x+w] = unpack(data, BITS_FOR_FORMAT[pixel_format], w)
+
+    def _load_img_end(self):
+        self.loading = None
+
+    def _send(self, nbytes):
+        seconds = nbytes*8/self.cost_model.spi_hz
+        self.bytes_sent += nbytes
+        self.spi_seconds += seconds
+        self._take(seconds)
+
+    def read_register(self, address):
+        return self.registers.get(address, 0)
+
+    def write_register(self, address, value):
+        self.registers[address] = value
+
+    def display_area(self, xy, dims, display_mode):
+        '''
+        Start refreshing an area with the pixels in the image buffer. The panel
+        shows the result right away, but is busy until the waveform would finish.
+        '''
+        x, y = xy
+        w, h = dims
+
+        if self.read_register(UP1SR+2) & (1 << 2):
+            # 1bpp mode: each byte of the buffer holds 8 pixels, which are drawn in the
+            # foreground or background gray value
+            bits = unpack(self.buffer[y:y+h, x//8:(x+w)//8].ravel(), 1, w)
+            gray = self.read_register(BGVR)
+            target = np.where(bits, gray >> 8, gray & 0xFF).astype(np.uint8)
+        else:
+            target = self.buffer[y:y+h, x:x+w]
+
+        self._refresh((x, y, x+w, y+h), target, display_mode)
+
+        self._take(self.cost_model.overhead)
+        start = max(self.now(), self.busy_until)
+        duration = self.cost_model.waveform_times.get(display_mode, 0)
+        self.busy_until = start + duration
+        self.busy_seconds += duration
+        self.refreshes[display_mode] = self.refreshes.get(display_mode, 0) + 1
+
+        if self.frames_dir is not None:
+            self.image().save(os.path.join(self.frames_dir, 'frame_{:06d}.png'.format(self.frames_saved)))
+            self.frames_saved += 1
+
+    def _refresh(self, box, target, mode):
+        x0, y0, x1, y1 = box
+        panel = self.panel[y0:y1, x0:x1]
+        ghosting = self.ghosting[y0:y1, x0:x1]
+
+        if mode == DisplayModes.INIT:
+            target = np.full_like(target, 0xFF)
+        elif mode in LEVELS:
+            # the fast waveforms drive each pixel to the nearest of their few levels
+            levels = LEVELS[mode]
+            target = (np.round(target/0xFF*(levels-1))*(0xFF//(levels-1))).astype(np.uint8)
+        else:
+            # the panel has 16 gray levels, and the controller takes the top 4 bits of
+            # each pixel, whatever format it was loaded in
+            target = (target >> 4)*0x11
+
+        changed = panel != target
+        if mode in GHOSTING:
+            # a bit of the old pixel is left behind wherever one changes
+            ghosting[changed] += GHOSTING[mode]*(panel[changed].astype(np.float32) - target[changed])
+        else:
+            ghosting *= 1 - CLEARING.get(mode, 0)
+
+        panel[:] = target
+
+    def image(self):
+        '''
+        What the panel looks like, ghosting and all, as a PIL image.
+        '''
+        return Image.fromarray(np.clip(self.panel + self.ghosting, 0, 0xFF).astype(np.uint8), 'L')
+
+    def report(self):
+        '''
+        A summary of how busy the simulated panel has been.
+        '''
+        return ('simulated panel: {} refreshes; {:.2f}s refreshing, {:.2f}s sending {:.1f} MB of pixels, '
+                '{:.2f}s waiting for it to be ready').format(
+            sum(self.refreshes.values()), self.busy_seconds, self.spi_seconds, self.bytes_sent/1e6,
+            self.wait_seconds,
+        )
@@ -0,0 +1,102 @@
+'''
+This file saves what the terminal and the panel were showing, so that when
+PaperTTY is restarted it can pick up where it left off, instead of clearing the
+panel and drawing the whole console again.
+
+What the panel shows can only be trusted if we exited cleanly: after a crash
+it may have been updated after the state was last saved. So a state saved
+on a timer is only used for the terminal's image of the console (which still
+saves drawing all of it), and the panel gets cleared as usual.
+'''
+
+import json
+import os
+import zipfile
+
+import numpy as np
+
+STATE_VERSION = 1
+
+def terminal_config(term, dims, flip, unicode):
+    '''
+    What the saved images depend on. A saved state is only used if all of
+    this is still the same.
+    '''
+    return {
+        'version': STATE_VERSION,
+        'dims': list(dims),
+        'flip': flip,
+        'unicode': unicode,
+        'font': [getattr(term.font, 'path', None), getattr(term.font, 'size', None)],
+        'bold_font': [getattr(term.bold_font, 'path', None), getattr(term.bold_font, 'size', None)],
+        'char_dims': list(term.char_dims),
+        'mono': term.glyphs.mono,
+    }
+
+def save_state(path, config, term, shown, clean):
+    '''
+    Save the terminal's data, cursor and image, and the panel's contents, to
+    path, replacing it all at once.
+
+    Parameters
+    ----------
+
+    path : str
+        Where to save it (as a numpy .npz file)
+
+    config : dict
+        As returned by terminal_config
+
+    term : papertty.render.Terminal
+        The terminal, which must have drawn something
+
+    shown : np.ndarray
+        What the panel shows, in the panel's orientation
+
+    clean : bool
+        Whether the panel will keep showing exactly shown, because we're exiting cleanly
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(
+            f,
+            config=np.array(json.dumps(config)),
+            clean=np.array(clean),
+            cursor_pos=np.array(term.cursor_pos if term.cursor_pos is not None else (-1, -1)),
+            data=term.data,
+            pixels=term.pixels,
+            shown=shown,
+        )
+    os.replace(tmp_path, path)
+
+def load_state(path, config):
+    '''
+    Load a state saved by save_state, if there is one and it was saved with the
+    same config.
+
+    Returns
+    -------
+
+    dict or None
+        With the keys clean, cursor_pos, data, pixels and shown
+    '''
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with np.load(path) as saved:
+            if json.loads(str(saved['config'])) != config:
+                print('Saved state in {} is for a different setup, not using it'.format(path))
+                return None
+
+            cursor_pos = tuple(int(x) for x in saved['cursor_pos'])
+            return {
+                'clean': bool(saved['clean']),
+                'cursor_pos': None if cursor_pos == (-1, -1) else cursor_pos,
+                'data': saved['data'],
+                'pixels': saved['pixels'],
+                'shown': saved['shown'],
+            }
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        print('Could not load saved state from {}: {}'.format(path, e))
+        return None
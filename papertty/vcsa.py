@@ -1,11 +1,21 @@
 
+import os
+import select
 import struct
 import fcntl
 import termios
+import zlib
+from time import sleep, perf_counter
 import numpy as np
 
 TTY_DTYPE = np.dtype([('char', np.ubyte), ('attr', np.ubyte)])
 
+# the same, but with the full unicode codepoint of each character (from /dev/vcsu)
+TTY_UNICODE_DTYPE = np.dtype([('char', np.uint32), ('attr', np.ubyte)])
+
+# holds the name of the virtual console in the foreground, e.g. 'tty1'
+ACTIVE_VT_PATH = '/sys/class/tty/tty0/active'
+
 def auto_resize_tty(ttyn, font_dims, display_dims):
     '''
     Find the number of rows and columns of font_dims that can fit in display_dims,
@@ -24,17 +34,24 @@ def auto_resize_tty(ttyn, font_dims, display_dims):
         except OSError:
             print("Could not set TTY size (rows={}, cols={}); continuing.".format(rows, cols))
 
+def vcsa_path(ttyn):
+    if not isinstance(ttyn, str):
+        return '/dev/vcsa{}'.format(ttyn)
+    else:
+        return ttyn  # mostly for debugging, allow reading arbitrary files
+
+def vcsu_path(ttyn):
+    if not isinstance(ttyn, str):
+        return '/dev/vcsu{}'.format(ttyn)
+    else:
+        return ttyn + 'u'  # for debugging, next to the vcsa file
+
 def read_vcsa(ttyn):
     '''
     Read the vcsa for tty number ttyn into numpy array
     '''
 
-    if not isinstance(ttyn, str):
-        vcsa = '/dev/vcsa{}'.format(ttyn)
-    else:
-        vcsa = ttyn  # mostly for debugging, allow reading arbitrary files
-
-    with open(vcsa, 'rb') as f:
+    with open(vcsa_path(ttyn), 'rb') as f:
         # read the first 4 bytes to get the console attributes
         attributes = f.read(4)
         raw_data = f.read()
@@ -47,6 +64,275 @@ def read_vcsa(ttyn):
     # terminal size is returned implicitly as the dimensions of the data array
     return (cursor_x, cursor_y), data
 
+class VcsaReader:
+    '''
+    Reads a console over and over, without reopening the device or allocating
+    new arrays for each frame.
+
+    The device stays open, and each read goes into the spare one of three
+    preallocated buffers. If the raw contents (including the cursor position)
+    hash the same as the last frame, the read is reported as unchanged and the
+    buffers stay as they were. Otherwise the buffers rotate, so that `current`
+    and `previous` are numpy views of the latest two distinct frames.
+
+    Since the buffers get reused, the array returned by read() is only valid
+    until the read after the next changed one. Keep a copy if you need it
+    for longer than that.
+
+    With unicode=True, the characters are read from /dev/vcsu (which has the
+    codepoint of each character as 32 bits, instead of the console font's
+    8-bit index), and the arrays have TTY_UNICODE_DTYPE. This needs Linux 5.0.
+    '''
+
+    def __init__(self, ttyn, unicode=False):
+        self.path = vcsa_path(ttyn)
+        self.fd = os.open(self.path, os.O_RDONLY)
+
+        self.unicode = unicode
+        self.text_fd = os.open(vcsu_path(ttyn), os.O_RDONLY) if unicode else None
+
+        # whether the last read was the same as the one before it
+        self.unchanged = False
+
+        # whether the console changed size during the last read
+        self.resized = False
+
+        self.digest = None
+        rows, cols = os.pread(self.fd, 2, 0)
+        self._allocate(rows, cols)
+
+    def __del__(self):
+        if getattr(self, 'fd', None) is not None:
+            os.close(self.fd)
+        if getattr(self, 'text_fd', None) is not None:
+            os.close(self.text_fd)
+
+    @property
+    def current(self):
+        return self.views[self.index]
+
+    @property
+    def previous(self):
+        return self.views[self.previous_index]
+
+    def read(self):
+        '''
+        Read the console. Returns the same thing as read_vcsa: a tuple of the
+        cursor position and the numpy array of terminal data.
+        '''
+        self.resized = False
+
+        while True:
+            # the buffer that is neither current nor previous
+            spare = 3 - self.index - self.previous_index
+            buf = self.buffers[spare]
+            nbytes = os.preadv(self.fd, [buf], 0)
+
+            rows, cols, cursor_x, cursor_y = buf[:4]
+            if (rows, cols) == self.dims and nbytes == len(buf):
+                if not self.unicode or os.preadv(self.text_fd, [self.text], 0) == len(self.text):
+                    break
+
+            # the console was resized, so the buffers are the wrong size
+            self.resized = True
+            self._allocate(rows, cols)
+
+        digest = zlib.crc32(buf)
+        if self.unicode:
+            digest = zlib.crc32(self.text, digest)
+        self.unchanged = digest == self.digest
+
+        if not self.unchanged:
+            self.digest = digest
+            self.previous_index, self.index = self.index, spare
+
+            if self.unicode:
+                # the characters from vcsu and the attributes from vcsa, together
+                merged = self.views[self.index]
+                merged['char'] = self.codepoints
+                merged['attr'] = self.attrs[self.index]['attr']
+
+        return (cursor_x, cursor_y), self.current
+
+    def _allocate(self, rows, cols):
+        self.dims = (rows, cols)
+        self.buffers = [bytearray(4 + rows*cols*TTY_DTYPE.itemsize) for _ in range(3)]
+        self.views = [
+            np.frombuffer(buf, dtype=TTY_DTYPE, count=rows*cols, offset=4).reshape(rows, cols)
+            for buf in self.buffers
+        ]
+
+        if self.unicode:
+            # vcsu has no header, just a native-endian 32-bit codepoint for each cell
+            self.text = bytearray(rows*cols*4)
+            self.codepoints = np.frombuffer(self.text, dtype=np.uint32).reshape(rows, cols)
+
+            # what we return are these, and the raw vcsa buffers only hold the attributes
+            self.attrs = self.views
+            self.views = [np.zeros((rows, cols), dtype=TTY_UNICODE_DTYPE) for _ in range(3)]
+
+        self.index = 0
+        self.previous_index = 1
+        self.digest = None
+
+class VcsaWaiter:
+    '''
+    Waits until the contents of a console have (probably) changed.
+
+    The kernel supports poll() on /dev/vcsa*: POLLPRI is signaled when the console
+    gets updated, and reading from the file descriptor resets it. If that turns out
+    not to work, we fall back to polling the console adaptively, backing off while it
+    is idle and speeding back up as soon as something changes.
+
+    Parameters
+    ----------
+
+    ttyn : int
+        The tty number to watch
+
+    min_interval : float
+        The shortest time between two wakeups, in seconds. Changes that happen
+        closer together than this get coalesced into one frame.
+
+    max_interval : float
+        The longest time we ever wait, in seconds, so that the caller can still
+        do periodic work while the console is idle
+
+    backoff : float
+        When polling, the interval gets multiplied by this after each frame
+        without changes
+
+    watch : list of int
+        File descriptors of sysfs attributes (like ActiveVT.fd) whose changes
+        should also wake us up
+    '''
+
+    # how many changes found after a timeout before we stop trusting the events
+    max_missed_events = 3
+
+    def __init__(self, ttyn, min_interval=0.1, max_interval=0.5, backoff=1.5, watch=()):
+        self.path = vcsa_path(ttyn)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+
+        self.interval = min_interval
+        self.last_wakeup = 0
+        self.woken_by_event = False
+        self.missed_events = 0
+
+        self.fd = os.open(self.path, os.O_RDONLY)
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLPRI)
+
+        # sysfs signals a change with POLLPRI and POLLERR, and reading it rearms it
+        self.watched = list(watch)
+        for fd in self.watched:
+            self.poller.register(fd, select.POLLPRI | select.POLLERR)
+            os.pread(fd, 4096, 0)
+
+        # reading resets any pending event; if the console still reports an error
+        # after that, it doesn't support change notifications
+        os.pread(self.fd, 4, 0)
+        self.event_driven = not any(fd == self.fd and ev & select.POLLERR for fd, ev in self.poller.poll(0))
+        if not self.event_driven:
+            print('{} does not support poll(); polling it instead'.format(self.path))
+
+    def __del__(self):
+        if getattr(self, 'fd', None) is not None:
+            os.close(self.fd)
+
+    def wait(self):
+        '''
+        Block until the console may have changed, or until max_interval has passed.
+        Returns whether we were woken up by a change notification.
+        '''
+        self.woken_by_event = False
+
+        if self.event_driven:
+            for fd, ev in self.poller.poll(self.max_interval*1000):
+                if fd in self.watched:
+                    os.pread(fd, 4096, 0)
+                    self.woken_by_event = True
+                elif ev & (select.POLLERR | select.POLLHUP):
+                    # the console was deallocated; start over with a fresh descriptor
+                    self._reopen()
+                else:
+                    os.pread(self.fd, 4, 0)
+                    self.woken_by_event = True
+        else:
+            sleep(max(self.interval - (perf_counter() - self.last_wakeup), 0))
+
+        # don't go faster than min_interval, so bursts get coalesced
+        remaining = self.min_interval - (perf_counter() - self.last_wakeup)
+        if remaining > 0:
+            sleep(remaining)
+
+        self.last_wakeup = perf_counter()
+        return self.woken_by_event
+
+    def feedback(self, changed):
+        '''
+        Tell the waiter whether the console had changed after the last wakeup,
+        so that it can adapt.
+        '''
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval*self.backoff, self.max_interval)
+
+        if self.event_driven:
+            # a change we weren't told about means the events can't be trusted
+            if changed and not self.woken_by_event:
+                self.missed_events += 1
+                if self.missed_events >= self.max_missed_events:
+                    print('missed change notifications on {}; polling it instead'.format(self.path))
+                    self.event_driven = False
+            elif changed:
+                self.missed_events = 0
+
+    def switch(self, ttyn):
+        '''
+        Watch a different tty from now on.
+        '''
+        self.path = vcsa_path(ttyn)
+        self._reopen(delay=0)
+
+    def _reopen(self, delay=None):
+        self.poller.unregister(self.fd)
+        os.close(self.fd)
+        self.fd = None
+
+        sleep(self.min_interval if delay is None else delay)
+
+        self.fd = os.open(self.path, os.O_RDONLY)
+        self.poller.register(self.fd, select.POLLPRI)
+        os.pread(self.fd, 4, 0)
+
+class ActiveVT:
+    '''
+    Finds out which virtual console is in the foreground. The kernel signals
+    changes to it through poll(), so fd can be passed to VcsaWaiter's watch
+    to wake up when the user switches consoles.
+    '''
+
+    def __init__(self, path=ACTIVE_VT_PATH):
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def __del__(self):
+        if getattr(self, 'fd', None) is not None:
+            os.close(self.fd)
+
+    def read(self):
+        '''
+        Get the number of the active tty, or None if it isn't a tty we know
+        how to read.
+        '''
+        name = os.pread(self.fd, 32, 0).decode().strip()
+        if name.startswith('tty') and name[3:].isdigit():
+            return int(name[3:])
+        return None
+
 # TODO
 def valid_vcsa(vcsa):
     """Check that the vcsa device and associated terminal seem sane"""
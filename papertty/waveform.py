@@ -0,0 +1,141 @@
+'''
+This file decides which waveform mode to refresh an area of the display with,
+by looking at the pixels that are going to be shown there.
+
+The fastest waveforms only show black and white, the grayscale ones are
+slower, and GC16 (which is needed to show many gray levels well, like in
+images) is the slowest and flashes. So we want the fastest one that can
+show what's actually in the area.
+'''
+
+import numpy as np
+from IT8951.constants import DisplayModes
+
+from .planner import stronger_mode
+
+# a mode that clients of the Controller can ask for, to have it choose the
+# mode from the pixels instead
+AUTO_MODE = 127
+
+MODE_NAMES = {
+    getattr(DisplayModes, name): name
+    for name in ('INIT', 'DU', 'GC16', 'GL16', 'GLR16', 'GLD16', 'A2', 'DU4')
+}
+
+def black_and_white(pixels):
+    '''
+    Whether all of the pixels are pure black or white.
+    '''
+    return bool(np.all((pixels == 0x00) | (pixels == 0xFF)))
+
+def gray_levels(pixels):
+    '''
+    The fraction of the pixels at each of the 16 gray levels the panel can show.
+    '''
+    return np.bincount((pixels >> 4).ravel(), minlength=16) / max(pixels.size, 1)
+
+class WaveformPolicy:
+    '''
+    Chooses the waveform mode for each refresh, and counts how often it
+    chose each one.
+
+    Parameters
+    ----------
+
+    use_a2 : bool
+        Use A2 (faster than DU, but with more ghosting) for black and white
+        areas that were also black and white before. A2 can't show anything else,
+        nor can it change pixels that were gray.
+
+    max_gl16_levels : int
+        Areas with at most this many (of 16) gray levels are refreshed with GL16,
+        anything with more gets GC16
+
+    min_level_fraction : float
+        Gray levels that cover less than this fraction of an area are taken to be
+        the antialiased edges of text, and don't count as levels. Text is only ever
+        drawn in a couple of colors, but its edges use all the levels in between
+
+    max_antialias_fraction : float
+        If more than this fraction of an area is in levels that don't count, it's
+        not text (more likely an image), so it gets GC16
+    '''
+
+    def __init__(self, use_a2=False, max_gl16_levels=4, min_level_fraction=0.1, max_antialias_fraction=0.4):
+        self.use_a2 = use_a2
+        self.max_gl16_levels = max_gl16_levels
+        self.min_level_fraction = min_level_fraction
+        self.max_antialias_fraction = max_antialias_fraction
+
+        self.counts = {mode: 0 for mode in MODE_NAMES}
+        self.skipped = 0
+
+    def classify(self, pixels, previous=None):
+        '''
+        Get the mode to refresh an area with, without counting it.
+
+        Parameters
+        ----------
+
+        pixels : np.ndarray
+            The 8-bit pixels that the area should show
+
+        previous : np.ndarray, optional
+            The pixels the display currently shows there, if known
+
+        Returns
+        -------
+
+        int or None
+            The mode, or None if the area doesn't need refreshing at all
+        '''
+        if previous is not None and np.array_equal(pixels, previous):
+            return None
+
+        levels = gray_levels(pixels)
+        significant = levels >= self.min_level_fraction
+
+        if levels[~significant].sum() > self.max_antialias_fraction:
+            return DisplayModes.GC16
+
+        if self._black_and_white(levels):
+            if self.use_a2 and previous is not None and self._black_and_white(gray_levels(previous)):
+                return DisplayModes.A2
+            return DisplayModes.DU
+
+        if np.count_nonzero(significant) <= self.max_gl16_levels:
+            return DisplayModes.GL16
+        return DisplayModes.GC16
+
+    def _black_and_white(self, levels):
+        '''
+        Whether all the gray in an area is just antialiasing.
+        '''
+        return levels[1:15].max() < self.min_level_fraction and \
+            levels[1:15].sum() <= self.max_antialias_fraction
+
+    def select(self, pixels, previous=None, at_least=None):
+        '''
+        Like classify, but also counts the choice. If at_least is given, the
+        result is at least as strong a mode as that one (for example, if the
+        area was already planned with that mode).
+        '''
+        mode = self.classify(pixels, previous)
+        if mode is None:
+            self.skipped += 1
+            return None
+
+        if at_least is not None:
+            mode = stronger_mode(mode, at_least)
+
+        self.counts[mode] += 1
+        return mode
+
+    def stats(self):
+        '''
+        Get a dictionary of how many times each mode was chosen, by name, and
+        how many refreshes were skipped because nothing changed.
+        '''
+        stats = {MODE_NAMES[mode]: count for mode, count in self.counts.items()}
+        stats['skipped'] = self.skipped
+        return stats
@@ -13,6 +13,7 @@ def main():
         clear_display,
         display_gradient,
         partial_update,
+        batch_update,
         display_image_8bpp,
     ]
 
@@ -87,5 +88,19 @@ def partial_update(display):
     place_text(display.frame_buf, 'update', x_offset=+200)
     display.draw_partial(constants.DisplayModes.DU)
 
+def batch_update(display):
+    print('Starting batched update...')
+
+    # clear image to white
+    display.frame_buf.paste(0xFF, box=(0, 0, display.width, display.height))
+    display.draw_full(constants.DisplayModes.GC16)
+
+    # each word is drawn on its own, but they all show up in one refresh
+    print('  writing words...')
+    with display.batch():
+        for i, word in enumerate(['one', 'refresh', 'for', 'all']):
+            place_text(display.frame_buf, word, y_offset=(2*i-3)*display.height//10)
+            display.draw_partial(constants.DisplayModes.DU)
+
 if __name__ == '__main__':
     main()
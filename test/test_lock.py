@@ -0,0 +1,68 @@
+import multiprocessing
+import os
+
+from papertty.controller import take_lock, lock_holder
+
+# a pid that no process has (pid_max is at most 2**22)
+DEAD_PID = 2**22 + 1
+
+def write_lock(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+def test_take_free_lock(tmp_path):
+    path = str(tmp_path / 'lock')
+    assert lock_holder(path) is None
+    assert take_lock(path) is None
+    assert lock_holder(path) == os.getpid()
+
+def test_lock_held_by_live_process(tmp_path):
+    path = str(tmp_path / 'lock')
+    write_lock(path, '{}\n'.format(os.getppid()))
+    assert take_lock(path) == os.getppid()
+    assert lock_holder(path) == os.getppid()
+
+def test_stale_lock_is_taken_over(tmp_path):
+    path = str(tmp_path / 'lock')
+    write_lock(path, '{}\n'.format(DEAD_PID))
+    assert lock_holder(path) is None
+    assert not os.path.exists(path)
+
+    write_lock(path, '{}\n'.format(DEAD_PID))
+    assert take_lock(path) is None
+    assert lock_holder(path) == os.getpid()
+
+def test_garbage_lock_is_taken_over(tmp_path):
+    path = str(tmp_path / 'lock')
+    write_lock(path, 'not a pid')
+    assert take_lock(path) is None
+    assert lock_holder(path) == os.getpid()
+
+def _race(path, barrier, results):
+    barrier.wait()
+    results.put((os.getpid(), take_lock(path)))
+    barrier.wait()  # hold the lock until everyone has tried
+
+def test_only_one_process_takes_over_a_stale_lock(tmp_path):
+    path = str(tmp_path / 'lock')
+    for _ in range(20):
+        write_lock(path, '{}\n'.format(DEAD_PID))
+
+        barrier = multiprocessing.Barrier(6)
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_race, args=(path, barrier, results)) for _ in range(6)]
+        for process in processes:
+            process.start()
+        outcomes = [results.get(timeout=10) for _ in processes]
+        with open(path) as f:
+            holder = int(f.read())
+        for process in processes:
+            process.join()
+
+        winners = [pid for pid, result in outcomes if result is None]
+        assert winners == [holder]
+        assert all(result == holder for _, result in outcomes if result is not None)
+        os.remove(path)
+
+    # nothing left behind by the takeovers
+    assert os.listdir(str(tmp_path)) == []
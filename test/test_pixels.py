@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from papertty.pixels import pack, unpack, flip_packed, is_aligned, packed_size, pixel_alignment
+
+def random_pixels(shape, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, shape, dtype=np.uint8)
+
+@pytest.mark.parametrize('bpp', [1, 2, 4, 8])
+def test_round_trip_keeps_top_bits(bpp):
+    pixels = random_pixels((5, 32))
+    packed = pack(pixels, bpp)
+    assert packed.size == packed_size((32, 5), bpp)
+
+    unpacked = unpack(packed, bpp, 32)
+    assert unpacked.shape == pixels.shape
+    assert np.array_equal(unpacked >> (8-bpp), pixels >> (8-bpp))
+
+@pytest.mark.parametrize('bpp', [1, 2, 4])
+def test_unpack_fills_the_range(bpp):
+    pixels = np.array([[0x00, 0xFF]*8], dtype=np.uint8)
+    assert np.array_equal(unpack(pack(pixels, bpp), bpp, 16), pixels)
+
+def test_first_pixel_in_lowest_bits():
+    pixels = np.array([[0xFF] + [0x00]*7], dtype=np.uint8)
+    assert pack(pixels, 1).tolist() == [0x01]
+    assert pack(np.array([[0x00, 0xF0]], dtype=np.uint8), 4).tolist() == [0xF0]
+
+def test_pack_rejects_partial_bytes():
+    with pytest.raises(ValueError):
+        pack(np.zeros((2, 6), dtype=np.uint8), 1)
+
+@pytest.mark.parametrize('bpp', [1, 2, 4, 8])
+def test_flip_packed_is_flipping_the_pixels(bpp):
+    pixels = random_pixels((7, 48), seed=bpp)
+    flipped = flip_packed(pack(pixels, bpp), bpp)
+    assert np.array_equal(flipped, pack(pixels[::-1, ::-1], bpp))
+
+@pytest.mark.parametrize('bpp', [1, 2, 4, 8])
+def test_alignment(bpp):
+    align = pixel_alignment(bpp)
+    assert align*bpp == 16
+    assert is_aligned((align, 3), (2*align, 5), bpp)
+    if align > 1:
+        assert not is_aligned((1, 0), (align, 1), bpp)
+        assert not is_aligned((0, 0), (align+1, 1), bpp)
@@ -0,0 +1,56 @@
+from IT8951.constants import DisplayModes
+
+from papertty.planner import RefreshPlanner, CostModel, boxes_overlap, subtract_boxes, box_area
+
+DIMS = (1872, 1404)
+
+def test_nearby_regions_merge():
+    planner = RefreshPlanner(DIMS)
+    plan = planner.plan([((0, 0, 40, 20), DisplayModes.DU), ((40, 0, 80, 20), DisplayModes.DU)])
+    assert plan == [((0, 0, 80, 20), DisplayModes.DU)]
+
+def test_merged_region_gets_the_stronger_mode():
+    planner = RefreshPlanner(DIMS)
+    plan = planner.plan([((0, 0, 40, 20), DisplayModes.DU), ((40, 0, 80, 20), DisplayModes.GL16)])
+    assert plan == [((0, 0, 80, 20), DisplayModes.GL16)]
+
+def test_far_regions_stay_apart():
+    # with sending pixels costing a lot, merging across the screen isn't worth it
+    planner = RefreshPlanner(DIMS, cost_model=CostModel(spi_hz=1000000))
+    rects = [((0, 0, 40, 20), DisplayModes.DU), ((1800, 1380, 1840, 1400), DisplayModes.DU)]
+    assert planner.plan(rects) == rects
+
+def test_overlapping_regions_always_merge():
+    planner = RefreshPlanner(DIMS, cost_model=CostModel(overhead=0, waveform_times={DisplayModes.DU: 0}))
+    plan = planner.plan([((0, 0, 400, 400), DisplayModes.DU), ((200, 200, 600, 600), DisplayModes.DU)])
+    assert plan == [((0, 0, 600, 600), DisplayModes.DU)]
+
+def test_no_updates_overlap():
+    planner = RefreshPlanner(DIMS, cost_model=CostModel(spi_hz=1000000))
+    rects = [((x, y, x+30, y+20), DisplayModes.DU) for x in range(0, 1800, 170) for y in range(0, 1400, 130)]
+    plan = planner.plan(rects)
+    for i, (a, _) in enumerate(plan):
+        assert not any(boxes_overlap(a, b) for b, _ in plan[i+1:])
+
+    # and everything gets refreshed
+    for box, _ in rects:
+        assert not subtract_boxes(box, [b for b, _ in plan])
+
+def test_aligned_and_clipped():
+    planner = RefreshPlanner((1870, 1404))
+    plan = planner.plan([((5, 10, 13, 20), DisplayModes.DU), ((1867, 0, 1870, 5), DisplayModes.DU),
+                         ((30, 30, 30, 40), DisplayModes.DU)])
+    for (x0, y0, x1, y1), _ in plan:
+        assert x0 % 4 == 0
+        assert x1 % 4 == 0 or x1 == 1870
+    assert all(box_area(box) > 0 for box, _ in plan)
+
+def test_nothing_to_plan():
+    assert RefreshPlanner(DIMS).plan([]) == []
+
+def test_subtract_boxes():
+    pieces = subtract_boxes((0, 0, 100, 100), [(25, 25, 75, 75)])
+    assert sum(box_area(piece) for piece in pieces) == 100*100 - 50*50
+    assert not any(boxes_overlap(piece, (25, 25, 75, 75)) for piece in pieces)
+    assert subtract_boxes((0, 0, 10, 10), [(0, 0, 20, 20)]) == []
+    assert subtract_boxes((0, 0, 10, 10), [(10, 0, 20, 10)]) == [(0, 0, 10, 10)]
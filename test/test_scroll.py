@@ -0,0 +1,49 @@
+import numpy as np
+
+from papertty.render import find_scroll
+from papertty.vcsa import TTY_DTYPE
+
+def screen(rows=10, cols=20, seed=0):
+    rng = np.random.default_rng(seed)
+    data = np.zeros((rows, cols), dtype=TTY_DTYPE)
+    data['char'] = rng.integers(0x21, 0x7F, (rows, cols))
+    data['attr'] = 0x07
+    return data
+
+def test_whole_screen_scrolls_up():
+    old = screen()
+    new = old.copy()
+    new[:-2] = old[2:]
+    new[-2:] = screen(rows=2, seed=1)
+    assert find_scroll(old, new) == (0, 8, 2)
+
+def test_scroll_region_moves_down():
+    old = screen()
+    new = old.copy()
+    new[3:7] = old[2:6]
+    new[2] = screen(rows=1, seed=1)
+    assert find_scroll(old, new) == (3, 7, -1)
+
+def test_nothing_scrolled():
+    old = screen()
+    new = old.copy()
+    new[4] = screen(rows=1, seed=1)
+    assert find_scroll(old, new) is None
+    assert find_scroll(old, old.copy()) is None
+
+def test_blank_rows_dont_count():
+    old = np.zeros((10, 20), dtype=TTY_DTYPE)
+    old['char'] = 0x20
+    new = old.copy()
+    new[-1]['char'][0] = ord('x')
+    assert find_scroll(old, new) is None
+
+def test_band_too_small():
+    old = screen()
+    new = screen(seed=2)
+    new[5] = old[6]
+    assert find_scroll(old, new) is None
+    assert find_scroll(old, new, min_rows=1) == (5, 6, 1)
+
+def test_different_shapes():
+    assert find_scroll(screen(rows=10), screen(rows=11)) is None
@@ -0,0 +1,52 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from papertty.state import save_state, load_state
+from papertty.vcsa import TTY_DTYPE
+
+CONFIG = {'version': 1, 'dims': [100, 40], 'flip': False}
+
+def make_term(cursor_pos=(3, 1)):
+    data = np.zeros((2, 10), dtype=TTY_DTYPE)
+    data['char'] = np.arange(20).reshape(2, 10) + 0x41
+    data['attr'] = 0x07
+    pixels = np.random.default_rng(0).integers(0, 256, (40, 100), dtype=np.uint8)
+    return SimpleNamespace(cursor_pos=cursor_pos, data=data, pixels=pixels)
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'state.npz')
+    term = make_term()
+    shown = term.pixels[::-1, ::-1].copy()
+    save_state(path, CONFIG, term, shown, clean=True)
+
+    state = load_state(path, dict(CONFIG))
+    assert state['clean'] is True
+    assert state['cursor_pos'] == (3, 1)
+    assert np.array_equal(state['data'], term.data)
+    assert state['data'].dtype == TTY_DTYPE
+    assert np.array_equal(state['pixels'], term.pixels)
+    assert np.array_equal(state['shown'], shown)
+    assert not (tmp_path / 'state.npz.tmp').exists()
+
+def test_no_cursor(tmp_path):
+    path = str(tmp_path / 'state.npz')
+    term = make_term(cursor_pos=None)
+    save_state(path, CONFIG, term, term.pixels, clean=False)
+
+    state = load_state(path, CONFIG)
+    assert state['cursor_pos'] is None
+    assert state['clean'] is False
+
+def test_different_config(tmp_path):
+    path = str(tmp_path / 'state.npz')
+    term = make_term()
+    save_state(path, CONFIG, term, term.pixels, clean=True)
+    assert load_state(path, dict(CONFIG, flip=True)) is None
+
+def test_missing_or_corrupt(tmp_path):
+    path = tmp_path / 'state.npz'
+    assert load_state(str(path), CONFIG) is None
+
+    path.write_bytes(b'not a saved state')
+    assert load_state(str(path), CONFIG) is None
@@ -0,0 +1,54 @@
+from IT8951.constants import DisplayModes
+
+from papertty.controller import UpdateQueue
+from papertty.waveform import AUTO_MODE
+
+def test_updates_come_out_in_order():
+    queue = UpdateQueue()
+    queue.put((0, 0, 10, 10), DisplayModes.DU, 1)
+    queue.put((20, 0, 30, 10), DisplayModes.GL16, 2)
+
+    updates = queue.take()
+    assert [(u['box'], u['mode'], u['seq']) for u in updates] == [
+        ((0, 0, 10, 10), DisplayModes.DU, 1),
+        ((20, 0, 30, 10), DisplayModes.GL16, 2),
+    ]
+    assert queue.take() == []
+
+def test_covered_update_is_dropped():
+    queue = UpdateQueue()
+    queue.put((10, 10, 20, 20), DisplayModes.GL16, 1, bpp=4)
+    queue.put((0, 0, 50, 50), DisplayModes.DU, 2, bpp=1)
+
+    update, = queue.take()
+    assert update['box'] == (0, 0, 50, 50)
+    assert update['seq'] == 2
+    assert update['covered'] == [1]
+    assert queue.dropped == 1
+
+    # it needs to show what the dropped one would have
+    assert update['mode'] == DisplayModes.GL16
+    assert update['bpp'] == 4
+
+def test_covered_chains_are_acknowledged():
+    queue = UpdateQueue()
+    queue.put((0, 0, 10, 10), DisplayModes.DU, 1)
+    queue.put((0, 0, 20, 20), DisplayModes.DU, 2)
+    queue.put((0, 0, 30, 30), DisplayModes.DU, 3)
+
+    update, = queue.take()
+    assert update['seq'] == 3
+    assert sorted(update['covered']) == [1, 2]
+
+def test_partial_overlap_keeps_both():
+    queue = UpdateQueue()
+    queue.put((0, 0, 20, 20), DisplayModes.DU, 1)
+    queue.put((10, 10, 30, 30), DisplayModes.DU, 2)
+    assert [u['seq'] for u in queue.take()] == [1, 2]
+
+def test_auto_mode_keeps_its_own_mode():
+    queue = UpdateQueue()
+    queue.put((0, 0, 10, 10), DisplayModes.GC16, 1)
+    queue.put((0, 0, 20, 20), AUTO_MODE, 2)
+    update, = queue.take()
+    assert update['mode'] == AUTO_MODE
@@ -0,0 +1,76 @@
+import numpy as np
+
+from papertty.vcsa import VcsaReader, read_vcsa, TTY_DTYPE
+
+def write_console(path, text, cursor=(0, 0), rows=4, cols=8):
+    data = np.zeros((rows, cols), dtype=TTY_DTYPE)
+    data['char'] = 0x20
+    data['attr'] = 0x07
+    for y, line in enumerate(text):
+        data['char'][y, :len(line)] = [ord(c) for c in line]
+
+    # a regular file is rewritten in place, like the device
+    with open(path, 'r+b' if path.exists() else 'wb') as f:
+        f.write(bytes([rows, cols, cursor[0], cursor[1]]) + data.tobytes())
+        f.truncate()
+    return data
+
+def test_reads_like_read_vcsa(tmp_path):
+    path = tmp_path / 'vcsa'
+    data = write_console(path, ['hello', 'world'], cursor=(5, 1))
+
+    cursor, read = VcsaReader(str(path)).read()
+    assert cursor == (5, 1)
+    assert np.array_equal(read, data)
+    assert read_vcsa(str(path))[0] == cursor
+    assert np.array_equal(read_vcsa(str(path))[1], read)
+
+def test_unchanged_reads(tmp_path):
+    path = tmp_path / 'vcsa'
+    write_console(path, ['one'])
+    reader = VcsaReader(str(path))
+
+    reader.read()
+    assert not reader.unchanged
+    reader.read()
+    assert reader.unchanged
+
+    # the cursor moving is a change
+    write_console(path, ['one'], cursor=(3, 0))
+    reader.read()
+    assert not reader.unchanged
+
+def test_previous_is_the_last_distinct_frame(tmp_path):
+    path = tmp_path / 'vcsa'
+    first = write_console(path, ['one'])
+    reader = VcsaReader(str(path))
+    reader.read()
+
+    second = write_console(path, ['two'])
+    reader.read()
+    assert np.array_equal(reader.previous, first)
+    assert np.array_equal(reader.current, second)
+
+    # unchanged reads leave both alone
+    for _ in range(3):
+        _, data = reader.read()
+        assert reader.unchanged
+        assert np.array_equal(data, second)
+        assert np.array_equal(reader.previous, first)
+
+    third = write_console(path, ['three'])
+    reader.read()
+    assert np.array_equal(reader.previous, second)
+    assert np.array_equal(reader.current, third)
+
+def test_resize(tmp_path):
+    path = tmp_path / 'vcsa'
+    write_console(path, ['small'])
+    reader = VcsaReader(str(path))
+    reader.read()
+
+    data = write_console(path, ['bigger now'], rows=6, cols=12)
+    _, read = reader.read()
+    assert reader.resized
+    assert read.shape == (6, 12)
+    assert np.array_equal(read, data)
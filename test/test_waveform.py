@@ -0,0 +1,56 @@
+import numpy as np
+from IT8951.constants import DisplayModes
+
+from papertty.waveform import WaveformPolicy, black_and_white
+
+def text_like(gray=0x00, size=(40, 100), edges=0.05, seed=0):
+    '''
+    Mostly white, with some pixels in one color and a few antialiased edges.
+    '''
+    rng = np.random.default_rng(seed)
+    pixels = np.full(size, 0xFF, dtype=np.uint8)
+    pixels[rng.random(size) < 0.2] = gray
+    edge = rng.random(size) < edges
+    pixels[edge] = rng.integers(0x10, 0xF0, np.count_nonzero(edge))
+    return pixels
+
+def test_unchanged_area_needs_no_refresh():
+    pixels = text_like()
+    assert WaveformPolicy().classify(pixels, pixels.copy()) is None
+
+def test_black_and_white_text_gets_du():
+    assert WaveformPolicy().classify(text_like()) == DisplayModes.DU
+    assert WaveformPolicy().classify(text_like(edges=0)) == DisplayModes.DU
+
+def test_a2_only_from_black_and_white():
+    policy = WaveformPolicy(use_a2=True)
+    assert policy.classify(text_like(seed=1), text_like(seed=2)) == DisplayModes.A2
+    assert policy.classify(text_like(seed=1), np.full((40, 100), 0x80, dtype=np.uint8)) == DisplayModes.DU
+    assert policy.classify(text_like(seed=1)) == DisplayModes.DU
+
+def test_gray_text_gets_gl16():
+    assert WaveformPolicy().classify(text_like(gray=0x80)) == DisplayModes.GL16
+
+def test_image_gets_gc16():
+    gradient = np.tile(np.arange(256, dtype=np.uint8), (40, 1))
+    assert WaveformPolicy().classify(gradient) == DisplayModes.GC16
+
+    # too many distinct levels for GL16
+    levels = np.repeat(np.arange(0, 256, 0x20, dtype=np.uint8), 10)
+    assert WaveformPolicy().classify(np.tile(levels, (40, 1))) == DisplayModes.GC16
+
+def test_select_counts():
+    policy = WaveformPolicy()
+    pixels = text_like()
+    assert policy.select(pixels) == DisplayModes.DU
+    assert policy.select(pixels, at_least=DisplayModes.GL16) == DisplayModes.GL16
+    assert policy.select(pixels, pixels) is None
+
+    stats = policy.stats()
+    assert stats['DU'] == 1
+    assert stats['GL16'] == 1
+    assert stats['skipped'] == 1
+
+def test_black_and_white():
+    assert black_and_white(np.array([0x00, 0xFF], dtype=np.uint8))
+    assert not black_and_white(np.array([0x00, 0x80], dtype=np.uint8))